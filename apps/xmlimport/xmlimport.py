@@ -2,6 +2,7 @@ from lxml import etree
 from datetime import date, time, datetime
 
 import sys
+from contextlib import contextmanager
 
 from flow import Flow
 from flow.needs import NeedsStore, NeedsClient, NeedsConfig
@@ -13,6 +14,7 @@ from flow.operation import (
 )
 from flow.lock import Locked
 from flow.data import MultiParser
+from flow.store import StoreUnversioned
 
 from vizone import logging
 from vizone.iso8601 import Timestamp
@@ -89,13 +91,18 @@ class XmlImport(Flow, NeedsClient, NeedsStore, NeedsConfig):
         xpath = /path/to/value
         type = string|integer|date|time|datetime|dictionary
         format = formatstring for parsing dates
+        multiple = no|yes
 
     For each field you want to parse, create one of these. For string fields, you only
     need the ``xpath``, since ``type`` defaults to ``string``. The value will be stored
     under the name NAME for later use with the mapper. Fields of type ``dictionary``
-    will require a ``source`` argument, being an http link to the dictionary feed. Field
+    will require a ``source`` argument, being an http link to the dictionary feed, and
+    take the optional ``ignore case`` and ``aliases`` arguments (see
+    :class:`flow.data.MultiParser`). Field
     of type ``datetime`` support a ``default timezone`` argument, which should be parsable
-    by python; for instance ``Europe/Stockholm`` or ``GMT``.
+    by python; for instance ``Europe/Stockholm`` or ``GMT``. With ``multiple = yes``,
+    all the values the ``xpath`` matches are converted, and stored as a list, for
+    instance for keywords or segments. By default only the first one is used.
 
     .. code-block:: ini
 
@@ -126,6 +133,7 @@ class XmlImport(Flow, NeedsClient, NeedsStore, NeedsConfig):
     def configure(self, config):
         self.mappings = {}
         self.xml_format = config.get("Xml", "format")
+        self.versioned = True  # see update
 
         if self.xml_format == 'default':  # else custom
             return
@@ -152,6 +160,14 @@ class XmlImport(Flow, NeedsClient, NeedsStore, NeedsConfig):
         else:
             self.vdf_mappings = {}
 
+    def key(self, f):
+        # Events for the same file are run in order, see [Flow] key affinity
+        return f.title
+
+    def priority(self, f):
+        # XML files unblock the imports of their media files, so take them first
+        return 1 if is_xml(f) else 0
+
     def start(self, f):
         # Queue up multiple events for the same file
         with Locked(f.title):
@@ -199,42 +215,106 @@ class XmlImport(Flow, NeedsClient, NeedsStore, NeedsConfig):
                 if media_filename:
                     logging.info('Wants media file %s.', media_filename)
 
-                    # Check if we have a MIN for it already
-                    stored_info = self.store.get(media_filename)
-                    if stored_info is not None and stored_info.get('type') == 'media':
+                    # Check if we have a MIN for it already, and claim it or
+                    # remember the asset in one atomic update, since the media
+                    # file may come in at the same time
+                    claimed = {}
+
+                    def pair(stored_info):
+                        claimed.clear()
+                        if stored_info is not None and stored_info.get('type') == 'media':
+                            claimed.update(stored_info)
+                            return None
+                        return {'type': 'asset', 'link': asset.self_link.href}
+
+                    self.update(media_filename, pair)
+                    if claimed:
 
                         # Start the import
-                        import_unmanaged_file(
-                            asset,
-                            UriList([stored_info.get('link')]),
-                            client=self.client,
-                        )
-                        self.store.delete(media_filename)
+                        with self.unclaim_on_error(media_filename, claimed):
+                            import_unmanaged_file(
+                                asset,
+                                UriList([claimed.get('link')]),
+                                client=self.client,
+                            )
                     else:
                         logging.info('Remember media file %s -> asset %s.',
                                      media_filename, asset.id)
-                        self.store.put(media_filename,
-                                       {'type': 'asset', 'link': asset.self_link.href})
 
             else:  # Media file
 
-                # Check if there is an XML that mentioned this media file
-                stored_info = self.store.get(f.title)
-                if stored_info is not None and stored_info.get('type') == 'asset':
+                # Check if there is an XML that mentioned this media file, and
+                # claim it or remember the media file in one atomic update
+                claimed = {}
+
+                def pair(stored_info):
+                    claimed.clear()
+                    if stored_info is not None and stored_info.get('type') == 'asset':
+                        claimed.update(stored_info)
+                        return None
+                    elif stored_info is None:
+                        return {'type': 'media', 'link': f.self_link.href}
+                    return stored_info
+
+                stored_info = self.update(f.title, pair)
+                if claimed:
 
                     # Fetch the asset and import to it
-                    asset = Item(self.client.GET(stored_info.get('link')))
-                    import_unmanaged_file(
-                        asset,
-                        UriList([f.self_link.href]),
-                        client=self.client,
-                    )
-                    self.store.delete(f.title)
-
-                elif stored_info is None:
+                    with self.unclaim_on_error(f.title, claimed):
+                        asset = Item(self.client.GET(claimed.get('link')))
+                        import_unmanaged_file(
+                            asset,
+                            UriList([f.self_link.href]),
+                            client=self.client,
+                        )
+
+                elif stored_info.get('link') == f.self_link.href:
                     logging.info('Remember media file %s -> unmanaged file %s.',
                                  f.title, f.self_link.href)
-                    self.store.put(f.title, {'type': 'media', 'link': f.self_link.href})
+
+    def update(self, key, func):
+        """
+        Update a pairing record atomically, see
+        :meth:`flow.store.Store.update`. If the store has no versions to
+        compare with, the record is read and written under a lock instead,
+        which only holds between threads or processes sharing the lock
+        backend (see :func:`flow.lock.set_backend`).
+        """
+        if self.versioned:
+            try:
+                return self.store.update(key, func)
+            except StoreUnversioned as e:
+                logging.warn('%s, pairing under a lock instead.', str(e))
+                self.versioned = False
+
+        with Locked(u'pairing:%s' % key):
+            stored_info = self.store.get(key)
+            new_info = func(stored_info)
+            if new_info is None:
+                if stored_info is not None:
+                    self.store.delete(key)
+            elif new_info != stored_info:
+                self.store.put(key, new_info)
+            return new_info
+
+    @contextmanager
+    def unclaim_on_error(self, key, claimed):
+        """
+        Put a claimed pairing record back if the import fails, so that the
+        file can still be paired when the event comes again.
+        """
+        try:
+            yield
+        except Exception:
+            def restore(stored_info):
+                return dict(claimed) if stored_info is None else stored_info
+
+            try:
+                if self.update(key, restore) == claimed:
+                    logging.info('Import failed, remember %s again.', key)
+            except Exception as e:
+                logging.error('Could not remember %s again: %s', key, str(e))
+            raise
 
     def custom_parse(self, filename, xml_string):
         dom = etree.fromstring(xml_string)
@@ -245,12 +325,12 @@ class XmlImport(Flow, NeedsClient, NeedsStore, NeedsConfig):
         }
         for fieldname, field in self.fields.items():
             elements = dom.xpath(field.xpath, namespaces=self.namespaces)
-            raw_value = elements[0] if len(elements) else None
-            try:
-                raw_value = raw_value.text
-            except:
-                pass
-            data[fieldname] = field.get_value(raw_value, self.client)
+            if field.multiple:
+                data[fieldname] = field.get_values(
+                    [element_text(element) for element in elements], self.client)
+            else:
+                raw_value = element_text(elements[0]) if len(elements) else None
+                data[fieldname] = field.get_value(raw_value, self.client)
         logging.log("Data", data, 'pp')
 
         # Transforming
@@ -275,10 +355,19 @@ def is_xml(f):
     return f.title.lower().endswith('.xml')
 
 
+def element_text(element):
+    # xpath gives elements, or strings for text() and attributes
+    try:
+        return element.text
+    except:
+        return element
+
+
 class Field(object):
-    def __init__(self, name, xpath=None, **kwargs):
+    def __init__(self, name, xpath=None, multiple="no", **kwargs):
         self.name = name
         self.xpath = xpath
+        self.multiple = multiple.lower() in ("1", "yes", "true", "on")
         assert self.xpath is not None, "Field %s is missing an xpath" % self.name
         try:
             self._parser = MultiParser(**kwargs)
@@ -287,3 +376,6 @@ class Field(object):
 
     def get_value(self, raw_value, client):
         return self._parser.convert(raw_value, client)
+
+    def get_values(self, raw_values, client):
+        return self._parser.convert_many(raw_values, client)
@@ -0,0 +1,40 @@
+"""
+Per-value cost of dictionary term lookups in the MultiParser, for growing
+dictionary sizes. The indexed lookup should stay flat, while the old linear
+scan grows with the dictionary.
+
+    python benchmarks/dictionary_lookup.py
+"""
+import timeit
+
+from flow.data import DictionaryIndex, MultiParser
+
+
+class Term(object):
+    def __init__(self, key):
+        self.key = key
+
+
+class FakeDictionary(object):
+    def __init__(self, size):
+        self.entries = [Term(u'term-%i' % n) for n in range(size)]
+
+
+def linear(dictionary, key):
+    return [term for term in dictionary.entries if term.key == key].pop(0)
+
+
+if __name__ == '__main__':
+    print("%10s %15s %15s" % ('terms', 'scan (us)', 'index (us)'))
+    for size in (100, 1000, 10000, 50000):
+        dictionary = FakeDictionary(size)
+        source = 'bench:%i' % size
+        MultiParser.DictionaryCache[source] = DictionaryIndex(dictionary)
+        parser = MultiParser(type='dictionary', source=source)
+        key = u'term-%i' % (size - 1)
+
+        number = max(10, 100000 // size)
+        scan = timeit.timeit(lambda: linear(dictionary, key), number=number) / number
+        number = 100000
+        index = timeit.timeit(lambda: parser.convert(key, None), number=number) / number
+        print("%10i %15.2f %15.2f" % (size, scan * 1e6, index * 1e6))
@@ -3,6 +3,9 @@
 import sys
 import os
 import time
+import signal
+import tempfile
+import threading
 import ConfigParser
 from argparse import ArgumentParser
 
@@ -12,9 +15,10 @@ from vizone.net.message_queue import ConnectionManager
 from vizone.classutils import to_class
 
 from .base import Once, Iterable, EventBased
-from .multi import Pool, LogId
+from .multi import Pool, ProcessPool, Intake, Coalescer, Batcher, Lanes, LogId
 from .needs import NeedsStomp, NeedsClient, NeedsStore, NeedsConfig, NeedsCleanUp
-from .store import Store
+from .store import create_store, WriteBehindStore
+from . import lock
 
 
 def get_stomp(username, password, app_name, heartbeat_interval, heartbeat_timeout, heartbeats):
@@ -41,6 +45,28 @@ def get_stomp(username, password, app_name, heartbeat_interval, heartbeat_timeou
     return get_stomp.cached
 
 
+def get_store(app_name, client, config):
+    if hasattr(get_store, 'cached'):
+        return get_store.cached
+
+    get_store.cached = create_store(
+        config.get('Store', 'engine'),
+        "flow_" + app_name,
+        client=client,
+        path=config.get('Store', 'path') or
+            os.path.join(tempfile.gettempdir(), 'flow_%s_store.sqlite' % app_name),
+        cache_size=config.getint('Store', 'cache size'),
+        cache_ttl=config.getfloat('Store', 'cache ttl'),
+        negative_cache_ttl=config.getfloat('Store', 'negative cache ttl'),
+        snapshot=config.get('Store', 'servicedoc snapshot') or None,
+        write_behind=config.getfloat('Store', 'write behind'),
+        write_behind_batch=config.getint('Store', 'write behind batch'),
+        journal=config.get('Store', 'journal') or None,
+    )
+
+    return get_store.cached
+
+
 def equip(app_name, username, password, args, client, config, klass, obj):
     if issubclass(klass, NeedsStomp):
         stomp = get_stomp(username, password, app_name,
@@ -51,11 +77,47 @@ def equip(app_name, username, password, args, client, config, klass, obj):
     if issubclass(klass, NeedsClient):
         obj.set_client(client)
     if issubclass(klass, NeedsStore):
-        obj.set_store(Store("flow_" + app_name, client))
+        obj.set_store(get_store(app_name, client, config))
     if issubclass(klass, NeedsConfig):
         obj.configure(config)
 
 
+def create_client(config):
+    viz_one_hostname = os.path.expandvars(config.get('Viz One', 'hostname'))
+    viz_one_username = os.path.expandvars(config.get('Viz One', 'username'))
+    viz_one_password = os.path.expandvars(config.get('Viz One', 'password'))
+    viz_one_use_https = config.getboolean('Viz One', 'use https')
+    viz_one_check_certificates = config.getboolean('Viz One', 'check certificates')
+    viz_one_pem_file = os.path.expanduser(os.path.expandvars(config.get('Viz One', 'pem file'))) or None
+    viz_one_time_out = config.getfloat('Viz One', 'time out')
+
+    return init(
+        hostname=viz_one_hostname,
+        user=viz_one_username,
+        password=viz_one_password,
+        secure=viz_one_use_https,
+        verify=viz_one_pem_file or viz_one_check_certificates,
+        timeout=viz_one_time_out,
+    )
+
+
+def setup_process(app_name, username, password, args, config, Flow):
+    """
+    Set up a flow in a worker process of a :class:`flow.multi.ProcessPool`.
+    Each process gets its own client, store and Stomp connection.
+    """
+    if hasattr(get_stomp, 'cached'):
+        del get_stomp.cached
+    if hasattr(get_store, 'cached'):
+        del get_store.cached
+
+    client = create_client(config) if config.getboolean('Viz One', 'enabled') else None
+
+    flow = Flow(instance_name=app_name)
+    equip(app_name, username, password, args, client, config, Flow, flow)
+    return flow
+
+
 if __name__ == '__main__':
     argparser = ArgumentParser(usage='python -m flow ini-file')
 
@@ -85,6 +147,22 @@ if __name__ == '__main__':
     config.set('Flow', 'app name', 'default')
     config.set('Flow', 'class', None)
     config.set('Flow', 'workers', '1')
+    config.set('Flow', 'min workers', '')
+    config.set('Flow', 'max workers', '')
+    config.set('Flow', 'executor', 'thread')
+    config.set('Flow', 'concurrency', '1000')
+    config.set('Flow', 'stats interval', '60')
+    config.set('Flow', 'task timeout', '60')
+    config.set('Flow', 'overdue policy', 'hold')
+    config.set('Flow', 'grace period', '30')
+    config.set('Flow', 'priority aging', '0')
+    config.set('Flow', 'batch size', '0')
+    config.set('Flow', 'batch time', '100')
+    config.set('Flow', 'key affinity', 'no')
+    config.set('Flow', 'intake size', '1000')
+    config.set('Flow', 'intake policy', 'block')
+    config.set('Flow', 'spill directory', '')
+    config.set('Flow', 'coalesce window', '0')
 
     config.add_section('Source')
 
@@ -105,6 +183,23 @@ if __name__ == '__main__':
     config.set('Viz One', 'pem file', '')
     config.set('Viz One', 'time out', '60')
 
+    config.add_section('Store')
+    config.set('Store', 'engine', 'vizone')
+    config.set('Store', 'path', '')
+    config.set('Store', 'cache size', '0')
+    config.set('Store', 'cache ttl', '30')
+    config.set('Store', 'negative cache ttl', '5')
+    config.set('Store', 'servicedoc snapshot', '')
+    config.set('Store', 'write behind', '0')
+    config.set('Store', 'write behind batch', '100')
+    config.set('Store', 'journal', '')
+
+    config.add_section('Lock')
+    config.set('Lock', 'backend', '')
+    config.set('Lock', 'directory', '')
+    config.set('Lock', 'service class', 'flow.lock.LocalLockService')
+    config.set('Lock', 'lease', '30')
+
     config.add_section('Stomp')
     config.set('Stomp', 'heartbeats', 'yes')
     config.set('Stomp', 'heartbeat interval', '5')
@@ -142,6 +237,28 @@ if __name__ == '__main__':
     # Set up multi-threading
     workers = args.workers or config.getint('Flow', 'workers')
     workers = max(workers, 1)
+    min_workers = int(config.get('Flow', 'min workers') or workers)
+    max_workers = int(config.get('Flow', 'max workers') or workers)
+    executor = config.get('Flow', 'executor')
+    if executor not in ('thread', 'process', 'asyncio'):
+        raise ValueError("Unknown executor '%s', use thread, process or asyncio" % executor)
+    if executor == 'process' and config.getfloat('Store', 'write behind') > 0:
+        # Worker processes would share the journal and lose their buffers on exit
+        raise ValueError("Store write behind is not supported with the process executor")
+    concurrency = config.getint('Flow', 'concurrency')
+    stats_interval = config.getfloat('Flow', 'stats interval')
+    task_timeout = config.getfloat('Flow', 'task timeout')
+    overdue_policy = config.get('Flow', 'overdue policy')
+    grace_period = config.getfloat('Flow', 'grace period')
+    priority_aging = config.getfloat('Flow', 'priority aging')
+    batch_size = config.getint('Flow', 'batch size')
+    batch_time = config.getfloat('Flow', 'batch time')
+    key_affinity = config.getboolean('Flow', 'key affinity')
+    intake_size = config.getint('Flow', 'intake size')
+    intake_policy = config.get('Flow', 'intake policy')
+    spill_dir = config.get('Flow', 'spill directory') or \
+            os.path.join(tempfile.gettempdir(), 'flow_%s_spill' % app_name)
+    coalesce_window = config.getfloat('Flow', 'coalesce window')
 
     # Set up Logging
     logging_debug = config.get('Logging', 'level') == 'debug'
@@ -184,11 +301,52 @@ if __name__ == '__main__':
         'app name': app_name,
         'class': Flow.__name__,
         'workers': workers,
+        'min workers': min_workers,
+        'max workers': max_workers,
+        'executor': executor,
+        'concurrency': concurrency if executor == 'asyncio' else None,
+        'stats interval': stats_interval,
+        'task timeout': task_timeout,
+        'overdue policy': overdue_policy,
+        'grace period': grace_period,
+        'priority aging': priority_aging,
+        'batch size': batch_size,
+        '(milliseconds) batch time': batch_time,
+        'key affinity': key_affinity,
+        'intake size': intake_size,
+        'intake policy': intake_policy,
+        'spill directory': spill_dir if intake_policy == 'spill' else None,
+        '(seconds) coalesce window': coalesce_window,
         '(from ini path) working directory': working_dir,
         '(from main class SOURCE) source class': Flow.SOURCE.__name__,
         '(from $PYTHON_CONFIG_ROOT) base config dir': base_config_dir,
     }, 'pp')
 
+    # Set up locking between threads, processes or machines. Worker
+    # processes need a lock that holds between processes
+    lock_backend = config.get('Lock', 'backend') or \
+            ('file' if executor == 'process' else 'thread')
+    if lock_backend == 'thread' and executor == 'process':
+        raise ValueError("Lock backend thread is not supported with the process executor")
+    lock_directory = config.get('Lock', 'directory') or \
+            os.path.join(tempfile.gettempdir(), 'flow_%s_locks' % app_name)
+    lock_service_class = config.get('Lock', 'service class')
+    lock_lease = config.getfloat('Lock', 'lease')
+
+    if lock_backend == 'file':
+        lock.set_backend(lock.FileLockBackend(lock_directory))
+    elif lock_backend == 'service':
+        lock.set_backend(lock.ServiceLockBackend(to_class(lock_service_class)(), lease=lock_lease))
+    elif lock_backend != 'thread':
+        raise ValueError("Unknown lock backend '%s', use thread, file or service" % lock_backend)
+
+    logging.log("Lock settings", {
+        'backend': lock_backend,
+        'directory': lock_directory if lock_backend == 'file' else None,
+        'service class': lock_service_class if lock_backend == 'service' else None,
+        'lease': lock_lease if lock_backend == 'service' else None,
+    }, 'pp')
+
     # Set up Viz One Client Instance
     viz_one_enabled = config.getboolean('Viz One', 'enabled')
     viz_one_hostname = os.path.expandvars(config.get('Viz One', 'hostname'))
@@ -211,14 +369,7 @@ if __name__ == '__main__':
     }, 'pp')
 
     if viz_one_enabled:
-        client = init(
-            hostname=viz_one_hostname,
-            user=viz_one_username,
-            password=viz_one_password,
-            secure=viz_one_use_https,
-            verify=viz_one_pem_file or viz_one_check_certificates,
-            timeout=viz_one_time_out,
-        )
+        client = create_client(config)
     else:
         client = None
 
@@ -228,44 +379,176 @@ if __name__ == '__main__':
     flow = Flow(instance_name=app_name)
     equip(app_name, viz_one_username, viz_one_password, args, client, config, Flow, flow)
 
+    get_priority = getattr(flow, 'priority', None)
+
+    # Flows implementing start_batch get their events in batches if enabled
+    batching = batch_size > 1 and hasattr(flow, 'start_batch')
+    if batching and executor in ('process', 'asyncio'):
+        raise ValueError("Batching is not supported with the %s executor" % executor)
+
+    # Flows implementing key get events with the same key run in order, in
+    # one lane, if enabled
+    laning = key_affinity and hasattr(flow, 'key')
+    if laning and executor in ('process', 'asyncio'):
+        raise ValueError("Key affinity is not supported with the %s executor" % executor)
+    if laning and batching:
+        raise ValueError("Key affinity and batching can not be combined")
+
+    def create_pool():
+        if executor == 'asyncio':
+            from .aio import EventLoopPool
+            return EventLoopPool(
+                concurrency=concurrency,
+                join=True,
+                timeout=task_timeout,
+                stats_interval=stats_interval,
+                executor_workers=workers,
+            )
+        elif executor == 'process':
+            return ProcessPool(
+                workers=workers,
+                setup=setup_process,
+                setup_args=(app_name, viz_one_username, viz_one_password, args, config, Flow),
+                join=True,
+                timeout=task_timeout,
+                stats_interval=stats_interval,
+            )
+        # Flows with priorities need the events waiting in the (priority
+        # ordered) pool queue rather than in the (FIFO) intake
+        return Pool(workers=workers, join=True, timeout=task_timeout,
+                    stats_interval=stats_interval, overdue=overdue_policy,
+                    queue_size=intake_size if get_priority else None,
+                    aging=priority_aging,
+                    min_workers=min_workers, max_workers=max_workers)
+
+    # Stop on SIGTERM/SIGINT by stopping the source and draining the pool.
+    # A second signal terminates right away, in case the source does not stop
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        logging.info("Got signal %i, stopping (again to terminate)...", signum)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        stopping.set()
+        if hasattr(source, 'stop'):
+            source.stop()
+
+    def create_work(pool):
+        log_id = LogId()
+
+        def spawn(obj):
+            current_log_id = log_id.next()
+            spawned = pool.spawn(flow.start, obj, logger=logger, log_id=current_log_id,
+                                 priority=get_priority(obj) if get_priority else 0)
+            logging.info("Spawned (%s)." % (str(current_log_id)))
+            return spawned
+
+        def spawn_in_lane(obj):
+            current_log_id = log_id.next()
+            spawned = lanes.spawn(flow.key(obj), flow.start, obj, logger=logger,
+                                  log_id=current_log_id,
+                                  priority=get_priority(obj) if get_priority else 0)
+            logging.info("Spawned in lane (%s)." % (str(current_log_id)))
+            return spawned
+
+        if laning:
+            lanes = Lanes(pool, stats_interval=stats_interval)
+            return spawn_in_lane, lanes
+
+        if not batching:
+            return spawn, None
+
+        def spawn_batch(objs):
+            current_log_id = log_id.next()
+            pool.spawn(batcher.start, flow.start_batch, objs, logger=logger, log_id=current_log_id)
+            logging.info("Spawned batch of %i (%s).", len(objs), str(current_log_id))
+
+        batcher = Batcher(spawn_batch, size=batch_size, time=batch_time / 1000.,
+                          stats_interval=stats_interval)
+        return batcher.put, batcher
+
+    # All shutdown stages, up to flushing the store, share the grace period
+    shutdown = {}
+
+    def remaining():
+        deadline = shutdown.setdefault('deadline', time.time() + grace_period)
+        return max(0., deadline - time.time())
+
+    def drain(pool, intake=None, stage=None, coalescer=None):
+        left = 0
+        if coalescer is not None:
+            logging.info("Stopping coalescer...")
+            coalescer.close(remaining())
+        if intake is not None:
+            logging.info("Stopping intake...")
+            left = intake.close(remaining())
+        if isinstance(stage, Batcher):
+            stage.close(remaining())
+        completed, abandoned = pool.drain(remaining())
+        if isinstance(stage, Lanes):
+            left += stage.close()
+        logging.info("Completed %i tasks, abandoned %i tasks.",
+                     completed, abandoned + left)
+
+    # Once sources run the flow on the main thread, there is nothing to drain
+    if issubclass(Flow.SOURCE, (Iterable, EventBased)):
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
     # Run source.run once, which should call the workers' start method once or
     # more. No parallelisation is done here
     if issubclass(Flow.SOURCE, Once):
         obj = source.run()
-        flow.start(obj)
+        if executor == 'asyncio':
+            from .aio import run
+            run(flow.start, obj)
+        else:
+            flow.start(obj)
 
     # Run source.start multiple times as long as there are free workers in the
     # pool. Stop when source.next() raises StopIteration.
     elif issubclass(Flow.SOURCE, Iterable):
-        with Pool(workers=workers, join=True) as pool:
-            log_id = LogId()
+        with create_pool() as pool:
+            work, stage = create_work(pool)
 
             for obj in source:
-                current_log_id = log_id.next()
-                pool.spawn(flow.start, obj, logger=logger, log_id=current_log_id)
-                logging.info("Spawned worker (%s).", str(current_log_id))
+                if stopping.is_set():
+                    break
+                work(obj)
+            else:
+                logging.info("Source is out of data.")
 
-            logging.info("Source is out of data.")
+            if stopping.is_set():
+                drain(pool, stage=stage)
+            elif stage is not None:
+                stage.close()
 
     # Run source.start once and go to an idle loop. Source is typically an
     # event listener of some kind and will call the callback upon
-    # external triggers.
+    # external triggers. Events go through an intake queue, so that the
+    # source is not held up waiting for free workers.
     elif issubclass(Flow.SOURCE, EventBased):
-        with Pool(workers=workers, join=True) as pool:
-            log_id = LogId()
-
-            def work(obj):
-                current_log_id = log_id.next()
-                pool.spawn(flow.start, obj, logger=logger, log_id=current_log_id)
-                logging.info("Spawned (%s)." % (str(current_log_id)))
+        with create_pool() as pool:
+            work, stage = create_work(pool)
+            intake = Intake(work, size=intake_size, policy=intake_policy,
+                            spill_dir=spill_dir, stats_interval=stats_interval)
+            source.callback = intake.put
+
+            # Collapse bursts of events for the same key before the intake
+            coalescer = None
+            if coalesce_window > 0 and hasattr(source, 'key'):
+                coalescer = Coalescer(intake.put, source.key, window=coalesce_window,
+                                      size=intake_size, stats_interval=stats_interval)
+                source.callback = coalescer.put
 
-            source.callback = work
             source.run()
 
             if not source._has_event_loop:
-                while True:
+                while not stopping.is_set():
                     time.sleep(1)
 
+            drain(pool, intake, stage, coalescer)
+
     else:
         raise ValueError(
             "The Source class must inherit one of Once, Iterable or EventBased"
@@ -274,10 +557,15 @@ if __name__ == '__main__':
     # Clean Up
     if issubclass(Flow, NeedsCleanUp):
         logging.info("Cleaning up flow...")
-        obj.clean_up()
+        flow.clean_up()
 
     elif issubclass(Flow.SOURCE, NeedsCleanUp):
         logging.info("Cleaning up source...")
         source.clean_up()
 
+    logging.log("Lock statistics", lock.statistics(), 'pp')
+    if isinstance(get_store.__dict__.get('cached'), WriteBehindStore):
+        get_store.cached.close(remaining())
+    elif isinstance(flow, NeedsStore):
+        logging.log("Store statistics", flow.store.statistics(), 'pp')
     logging.info("End of program.")
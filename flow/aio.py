@@ -0,0 +1,228 @@
+import functools
+import threading
+import time
+import traceback
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from vizone import logging
+
+from .multi import Statistics, Task, _start_reporter, _local
+
+
+def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking call, like a ``client.GET``, in the executor of the event
+    loop and get a future for its result. Use from within a coroutine flow
+    (written for trollius on Python 2):
+
+    .. code-block:: python
+
+        import trollius as asyncio
+        from trollius import From
+        from flow.aio import run_blocking
+
+        class MyFlow(Flow, NeedsClient):
+            @asyncio.coroutine
+            def start(self, asset):
+                response = yield From(run_blocking(self.client.GET, asset.describedby_link))
+    """
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def run(worker, *args, **kwargs):
+    """
+    Run ``worker`` to completion in the current thread, on an event loop if
+    it is a coroutine function.
+    """
+    if not asyncio.iscoroutinefunction(worker):
+        return worker(*args, **kwargs)
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(worker(*args, **kwargs))
+    finally:
+        loop.close()
+
+
+def _run_in_thread(task):
+    # Make the deadline available to remaining_time in the executor thread
+    _local.task = task
+    try:
+        return task.run()
+    finally:
+        _local.task = None
+
+
+class EventLoopPool(object):
+    """
+    Pool running tasks on an asyncio event loop in a thread of its own, for
+    flows that mostly wait on I/O. It has the same ``spawn`` and context
+    manager API as :class:`flow.multi.Pool`, and ``spawn`` is safe to call
+    from any thread:
+
+        with EventLoopPool(concurrency=1000) as pool:
+            pool.spawn(flow.start, obj, logger=logger, log_id=log_id)
+
+    If the worker is a coroutine function (decorated with
+    ``@asyncio.coroutine``) it is run on the loop, otherwise it is run in the loop's default executor,
+    a thread pool of ``executor_workers`` threads. Blocking calls within
+    coroutines should go through :func:`run_blocking`.
+
+    At most ``concurrency`` tasks are in flight at the same time, ``spawn``
+    blocks when that many are. Tasks running for longer than ``timeout``
+    seconds are cancelled. Statistics are kept like for
+    :class:`flow.multi.Pool`.
+    """
+    def __init__(self, concurrency=1000, join=True, timeout=60, stats_interval=60,
+                 executor_workers=None):
+        logging.info("Create event loop pool for %i tasks (%s, timeout=%i).",
+                     concurrency, 'join' if join else 'no join', timeout)
+        self.start_time = time.time()
+
+        self.concurrency = concurrency
+        self.join = join
+        self.timeout = timeout
+
+        self.resource = threading.BoundedSemaphore(concurrency)
+        self.running_lock = threading.Lock()
+        self.running = {}
+        self.draining = False
+
+        self.stats = Statistics()
+        self.stopped = threading.Event()
+        _start_reporter(self, stats_interval)
+
+        self.loop = asyncio.new_event_loop()
+        if executor_workers:
+            from concurrent.futures import ThreadPoolExecutor
+            self.loop.set_default_executor(ThreadPoolExecutor(executor_workers))
+
+        self.thread = threading.Thread(target=self._run_loop, name='event_loop')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        logging.debug("Exit event loop pool.")
+        if self.join and not self.draining:
+            # Tasks are cancelled on their time out, so this will end
+            self._wait()
+        self.stopped.set()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(self.timeout)
+        total_time = time.time() - self.start_time
+        logging.info("Ran %i tasks in %f seconds (avg %f seconds per task).",
+                self.stats.count, total_time,
+                self.stats.total_run / max(self.stats.count, 1))
+        logging.log("Pool statistics", self.statistics(), 'pp')
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while self.running and (deadline is None or time.time() < deadline):
+            time.sleep(0.1)
+
+    def statistics(self):
+        """
+        Get the current task statistics of the pool.
+
+        Returns:
+            dict: See :meth:`flow.multi.Statistics.snapshot`, plus the number
+                  of running tasks
+        """
+        stats = self.stats.snapshot()
+        with self.running_lock:
+            stats['running'] = len(self.running)
+        return stats
+
+    def _start(self, task):
+        task.started = time.time()
+        task.deadline = task.started + self.timeout
+        try:
+            if asyncio.iscoroutinefunction(task.worker):
+                kwargs = dict(task.kwargs)
+                kwargs.pop('logger', None)
+                kwargs.pop('log_id', None)
+                work = task.worker(*task.args, **kwargs)
+            else:
+                work = self.loop.run_in_executor(None, functools.partial(_run_in_thread, task))
+
+            future = asyncio.ensure_future(
+                asyncio.wait_for(work, self.timeout), loop=self.loop)
+            with self.running_lock:
+                self.running[task] = future
+            future.add_done_callback(functools.partial(self._done, task))
+        except Exception:
+            # Never scheduled, so _done will not release the slot
+            logging.log("Task %s failed" % task.name, traceback.format_exc(), 'error')
+            self.stats.record(task.started - task.queued, time.time() - task.started,
+                              failed=True)
+            with self.running_lock:
+                self.running.pop(task, None)
+            self.resource.release()
+
+    def _done(self, task, future):
+        end_time = time.time()
+        failed = timed_out = False
+        try:
+            future.result()
+        except asyncio.TimeoutError:
+            timed_out = True
+            logging.error("Task %s timed out and was cancelled.", task.name)
+        except asyncio.CancelledError:
+            failed = True
+            logging.warn("Task %s was cancelled.", task.name)
+        except Exception:
+            failed = True
+            logging.log("Task %s failed" % task.name, traceback.format_exc(), 'error')
+
+        self.stats.record(task.started - task.queued, end_time - task.started,
+                          failed=failed, timed_out=timed_out)
+        with self.running_lock:
+            del self.running[task]
+        self.resource.release()
+
+    def drain(self, grace=30):
+        """
+        Stop taking on new tasks and wait at most ``grace`` seconds for
+        the running ones to finish. Tasks still running after that are
+        cancelled.
+
+        Returns:
+            tuple: (number of completed tasks, number of abandoned tasks)
+        """
+        logging.info("Draining event loop pool (grace period %f seconds)...", grace)
+        self.draining = True
+        self._wait(grace)
+        with self.running_lock:
+            futures = list(self.running.values())
+        for future in futures:
+            if future is not None:
+                self.loop.call_soon_threadsafe(future.cancel)
+        return self.stats.count, len(futures)
+
+    def spawn(self, worker, *args, **kwargs):
+        logging.debug("Start spawn.")
+        kwargs.pop('priority', None)
+        task = Task(worker, args, kwargs)
+        if self.draining:
+            logging.warn("Event loop pool is draining, not running %s.", task.name)
+            return False
+        self.resource.acquire()
+        # Counted as running from here, so that waiting for the pool to
+        # finish does not miss tasks that are not started yet
+        with self.running_lock:
+            self.running[task] = None
+        self.loop.call_soon_threadsafe(self._start, task)
+        logging.debug("Queued %s.", task.name)
+        return True
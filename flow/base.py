@@ -3,6 +3,23 @@ class Flow(object):
     For worker classes.
 
     Base class for all flow workers. Do inherit this.
+
+    A flow can define a ``priority(obj)`` method returning a number for each
+    event. When the workers are busy, events with a higher priority are
+    started first (see ``priority aging`` in the ``[Flow]`` section to keep
+    low priority events from waiting forever).
+
+    A flow can also define a ``start_batch(objs)`` method, which is then
+    called with lists of events instead of calling ``start`` for each, if
+    ``batch size`` is set in the ``[Flow]`` section. It should return a list
+    with one result per event, where an exception instance or ``False`` marks
+    a failed event (see :class:`flow.multi.Batcher`).
+
+    A flow can define a ``key(obj)`` method as well. With ``key affinity =
+    yes`` in the ``[Flow]`` section, events with the same key are then run
+    one at a time and in order by a single worker (see
+    :class:`flow.multi.Lanes`), rather than keeping several workers waiting
+    on a :class:`flow.lock.Locked`.
     """
     def __init__(self, instance_name=None):
         self.instance_name = instance_name
@@ -49,5 +66,16 @@ class EventBased(object):
 
     The source class does not have to call the ``callback()`` function but
     should do so for any asyncronous operations.
+
+    On shutdown, Flow calls ``stop()``, after which the source should stop
+    producing events (and return from ``run`` if it has its own event loop).
+
+    Sources can define a ``key(obj)`` method identifying what an event is
+    about (an asset id, a file name...). With ``coalesce window`` set in the
+    ``[Flow]`` section, bursts of events for the same key are then collapsed
+    into the latest one (see :class:`flow.multi.Coalescer`).
     """
     _has_event_loop = False
+
+    def stop(self):
+        self.callback = None
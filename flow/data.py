@@ -1,9 +1,334 @@
-from threading import Lock
+import re
+import time
+import collections
+from datetime import datetime
+from threading import Lock, Thread, Event
 from vizone.client import HTTPClientError
 from vizone.payload.dictionary import Dictionary
+from vizone.iso8601 import Timestamp
 from vizone import logging
 
 
+def _boolean(value):
+    # Options may come straight from the ini file
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'yes', 'true', 'on')
+    return bool(value)
+
+
+def _aliases(value):
+    # "alias = key, alias = key" from the ini file, or a dict
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return dict(value)
+    aliases = {}
+    for pair in value.split(','):
+        alias, sep, key = pair.partition('=')
+        assert sep, "Alias %s should be on the form alias=key" % pair.strip()
+        aliases[alias.strip()] = key.strip()
+    return aliases
+
+
+# Directives that can be parsed with a plain regular expression
+_Directives = {
+    'Y': r'(?P<year>\d{4})',
+    'y': r'(?P<short_year>\d{2})',
+    'm': r'(?P<month>\d{1,2})',
+    'd': r'(?P<day>\d{1,2})',
+    'H': r'(?P<hour>\d{1,2})',
+    'M': r'(?P<minute>\d{1,2})',
+    'S': r'(?P<second>\d{1,2})',
+    'f': r'(?P<microsecond>\d{1,6})',
+}
+
+
+def _compile_format(format):
+    """
+    Compile a ``strptime`` format into a faster parser function. Formats
+    made of numeric directives only are parsed with a regular expression,
+    anything else (and values not matching it) falls back to ``strptime``,
+    so the results and errors are the same.
+    """
+    def fallback(raw_value):
+        return datetime.strptime(raw_value, format)
+
+    pattern = []
+    parts = iter(re.split(r'(%.)', format))
+    for part in parts:
+        if not part.startswith('%') or len(part) != 2:
+            pattern.append(re.escape(part))
+        elif part == '%%':
+            pattern.append('%')
+        elif part[1] in _Directives and _Directives[part[1]] not in pattern:
+            pattern.append(_Directives[part[1]])
+        else:
+            return fallback
+    try:
+        regex = re.compile(''.join(pattern) + r'\Z')
+    except re.error:
+        return fallback
+
+    def parse(raw_value):
+        match = regex.match(raw_value)
+        if match is None:
+            return fallback(raw_value)
+        fields = match.groupdict()
+        if fields.get('short_year') is not None:
+            # Same pivot as strptime
+            year = int(fields['short_year'])
+            year += 1900 if year >= 69 else 2000
+        else:
+            year = int(fields.get('year') or 1900)
+        microsecond = fields.get('microsecond')
+        try:
+            return datetime(
+                year,
+                int(fields.get('month') or 1),
+                int(fields.get('day') or 1),
+                int(fields.get('hour') or 0),
+                int(fields.get('minute') or 0),
+                int(fields.get('second') or 0),
+                int(microsecond.ljust(6, '0')) if microsecond else 0,
+            )
+        except ValueError:
+            # Run-together fields may split differently in strptime
+            return fallback(raw_value)
+
+    return parse
+
+
+class DictionaryIndex(object):
+    """
+    A dictionary with its terms indexed by key, for constant time lookups.
+    Where several terms have the same key, the first one is used.
+
+    Args:
+        dictionary (vizone.payload.dictionary.Dictionary): The dictionary to index
+    """
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+        self.terms = {}
+        self.folded = {}
+        for term in dictionary.entries:
+            if term.key is None:
+                continue
+            self.terms.setdefault(term.key, term)
+            self.folded.setdefault(term.key.lower(), term)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def lookup(self, key, ignore_case=False):
+        """
+        Args:
+            key (unicode): Term key to look up
+            ignore_case (bool): Compare keys case insensitively
+
+        Returns:
+            vizone.payload.dictionary.Term: The term, or ``None`` if missing
+        """
+        term = self.terms.get(key)
+        if term is None and ignore_case:
+            term = self.folded.get(key.lower())
+        return term
+
+
+class DictionaryCache(object):
+    """
+    Bounded, thread-safe LRU cache of :class:`DictionaryIndex` by source
+    URL, for the :class:`MultiParser`. At most ``size`` dictionaries are
+    kept. Dictionaries older than ``ttl`` seconds are still used, but are
+    refreshed in the background, with ``If-None-Match`` so that an
+    unchanged dictionary only costs a ``304 Not Modified``. After a failed
+    refresh, the next one is tried ``retry`` seconds later at the earliest.
+
+    Cached dictionaries are read without locking. A missing dictionary is
+    fetched once, by the first thread asking for it, while other threads
+    asking for the same source wait for that fetch (and threads asking for
+    other sources do not wait at all). Hit counters are approximate.
+
+    To change the bounds, replace the cache of the parser before use:
+
+    .. code-block:: python
+
+        MultiParser.DictionaryCache = DictionaryCache(size=20, ttl=60)
+    """
+    def __init__(self, size=100, ttl=600, retry=60):
+        self.size = size
+        self.ttl = ttl
+        self.retry = retry
+        self._lock = Lock()
+        self._entries = {}  # source => _CachedDictionary
+        self._loading = {}  # source => _Flight
+        self._refreshing = set()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.not_modified = 0
+        self.refresh_errors = 0
+        self.evictions = 0
+
+    def __contains__(self, source):
+        return source in self._entries
+
+    def __getitem__(self, source):
+        return self._get(source, None)
+
+    def __setitem__(self, source, index):
+        self.set(source, index)
+
+    def set(self, source, index, etag=None, client=None):
+        """
+        Cache the ``index`` of ``source``, as of now.
+        """
+        with self._lock:
+            self._entries[source] = _CachedDictionary(index, etag, client)
+            while len(self._entries) > self.size:
+                # Least recently used, there are only a few dictionaries
+                oldest = min(self._entries, key=lambda key: self._entries[key].used)
+                del self._entries[oldest]
+                self.evictions += 1
+
+    def _get(self, source, client):
+        # No locking on this path, dict lookups and attribute writes are atomic
+        entry = self._entries.get(source)
+        if entry is None:
+            raise KeyError(source)
+        now = time.time()
+        entry.used = now
+        if now - entry.loaded < self.ttl:
+            self.hits += 1
+            return entry.index
+
+        with self._lock:
+            self.stale_hits += 1
+            if source in self._refreshing or (client or entry.client) is None:
+                return entry.index
+            self._refreshing.add(source)
+
+        refresher = Thread(target=self._refresh, args=(source, entry, client or entry.client),
+                           name='dictionary_refresh')
+        refresher.daemon = True
+        refresher.start()
+        return entry.index
+
+    def get(self, source, client):
+        """
+        Get the index of ``source``, loading it with ``client`` if not cached.
+
+        Returns:
+            DictionaryIndex
+        """
+        try:
+            return self._get(source, client)
+        except KeyError:
+            pass
+
+        with self._lock:
+            entry = self._entries.get(source)
+            if entry is not None:
+                return entry.index
+            self.misses += 1
+            flight = self._loading.get(source)
+            leader = flight is None
+            if leader:
+                flight = self._loading[source] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.index
+
+        try:
+            index, etag = _load_dictionary(source, client)
+            self.set(source, index, etag, client)
+            flight.index = index
+            return index
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._loading[source]
+            flight.done.set()
+
+    def _refresh(self, source, entry, client):
+        try:
+            response = client.GET(source, headers={'If-None-Match': entry.etag} if entry.etag else {},
+                                  check_status=False)
+            if response.status_code == 304:
+                with self._lock:
+                    self.not_modified += 1
+                    entry.loaded = time.time()
+                logging.debug("Dictionary %s not modified.", source)
+            elif response.status_code >= 400:
+                raise HTTPClientError(response)
+            else:
+                self.set(source, DictionaryIndex(Dictionary(response)),
+                         response.headers.get('ETag'), client)
+                with self._lock:
+                    self.refreshes += 1
+                logging.info("Refreshed dictionary %s.", source)
+        except Exception as e:
+            with self._lock:
+                self.refresh_errors += 1
+                # Keep using the old one, and back off before trying again
+                entry.loaded = time.time() + self.retry - self.ttl
+            logging.error("Could not refresh dictionary %s: %s", source, str(e))
+        finally:
+            with self._lock:
+                self._refreshing.discard(source)
+
+    def statistics(self):
+        """
+        Returns:
+            dict: Size and hit/miss/refresh counters of the cache
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'stale hits': self.stale_hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'not modified': self.not_modified,
+                'refresh errors': self.refresh_errors,
+                'evictions': self.evictions,
+            }
+
+
+class _CachedDictionary(object):
+    __slots__ = ('index', 'etag', 'client', 'loaded', 'used')
+
+    def __init__(self, index, etag, client):
+        self.index = index
+        self.etag = etag
+        self.client = client
+        self.loaded = self.used = time.time()
+
+
+class _Flight(object):
+    __slots__ = ('done', 'index', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.index = None
+        self.error = None
+
+
+def _load_dictionary(source, client):
+    try:
+        response = client.GET(source)
+    except HTTPClientError:
+        raise ValueError("Bad dictionary link: %s" % source)
+    etag = getattr(response, 'headers', {}).get('ETag')
+    return DictionaryIndex(Dictionary(response)), etag
+
+
 class MultiParser(object):
     """
     A value parser that converts various data formats into Python and Viz One
@@ -36,21 +361,47 @@ class MultiParser(object):
     For more information about date and time parsing syntax, please refer to
     https://docs.python.org/2/library/datetime.html#strftime-and-strptime-behavior
 
+    Dictionaries are fetched once per source and indexed by term key (see
+    :class:`DictionaryIndex`), and refreshed in the background when older
+    than the time to live of the :class:`DictionaryCache`. Keys can be matched case insensitively with
+    ``ignore_case``, and values that differ from the term keys can be
+    mapped with ``aliases``:
+
+    .. code-block:: ini
+
+        [Field:category]
+        xpath = /asset/category
+        type = dictionary
+        source = http://vizone/dictionary/category
+        ignore case = yes
+        aliases = Sport=sports, Politics=news
+
+    The ``format`` is compiled once into a parser. The latest
+    ``memo_size`` converted values of ``iso``, ``date``, ``time``
+    and ``datetime`` are remembered, as the same dates tend to come over
+    and over.
+
     Args:
         type (str): ``string|integer|float|iso|date|time|datetime|dictionary``
         format (str): format string for parseing ``date``, ``time`` and ``datetime``
         default_timezone (str): default time zone only used fore ``datetime``
         source (str): url do ``dictionary``, should be an Atom-based feed
+        ignore_case (bool): match ``dictionary`` term keys case insensitively
+        aliases (str|dict): ``alias=key`` pairs separated by comma, for ``dictionary``
+        memo_size (int): number of converted timestamps to remember, 0 disables
     """
     Types = {"string", "integer", "float", "iso", "date", "time", "datetime", "dictionary"}
-    DictionaryCache = {}
-    CacheLock = Lock()
+    DictionaryCache = DictionaryCache()
+    CacheLock = Lock()  # No longer used, kept for code that refers to it
 
-    def __init__(self, type="string", format=None, default_timezone="UTC", source=None):
+    def __init__(self, type="string", format=None, default_timezone="UTC", source=None,
+                 ignore_case=False, aliases=None, memo_size=1024):
         self.type = type
         self.format = format
         self.source = source
         self.default_timezone = default_timezone
+        self.ignore_case = _boolean(ignore_case)
+        self.aliases = _aliases(aliases)
 
         assert type in MultiParser.Types, "Converter type %s is not in %s" % (
                 self.type, str(MultiParser.Types))
@@ -59,10 +410,14 @@ class MultiParser(object):
             assert self.format, "Converter of type %s requires format" % (
                     self.type)
 
-        if type is "dictionary":
+        if type == "dictionary":
             assert self.source, "Converter of type %s requires source" % (
                     self.type)
 
+        self._parse = _compile_format(self.format) if self.format else None
+        self._memo = {}
+        self._memo_size = int(memo_size) if self.type in {"iso", "date", "time", "datetime"} else 0
+
     def convert(self, raw_value, client):
         """
         Perform conversion configured when contructing the object.
@@ -82,38 +437,55 @@ class MultiParser(object):
             return int(raw_value)
         elif self.type == "float":
             return float(raw_value)
-        elif self.type == "iso":
-            return Timestamp(raw_value)
-        elif self.type == "date":
-            d = datetime.strptime(raw_value, self.format).date()
-            t = Timestamp(d.isoformat())
-            return t
-        elif self.type == "time":
-            d = datetime.strptime(raw_value, self.format).time()
-            t = Timestamp(d.isoformat())
+        elif self._memo_size:
+            t = self._memo.get(raw_value)
+            if t is None:
+                t = self._convert_timestamp(raw_value)
+                if len(self._memo) >= self._memo_size:
+                    self._memo.clear()
+                self._memo[raw_value] = t
             return t
-        elif self.type == "datetime":
-            d = datetime.strptime(raw_value, self.format)
-            t = Timestamp(d.isoformat())
-            if not t.has_tz():
-                t = t.assume(self.default_timezone)
-            return t.utc()
+        elif self.type in {"iso", "date", "time", "datetime"}:
+            return self._convert_timestamp(raw_value)
         elif self.type == "dictionary":
-            try:
-                MultiParser.CacheLock.acquire()
-                if self.source in MultiParser.DictionaryCache.keys():
-                    dictionary = MultiParser.DictionaryCache[self.source]
-                else:
-                    try:
-                        dictionary = Dictionary(client.GET(self.source))
-                        MultiParser.DictionaryCache[self.source] = dictionary
-                    except HTTPClientError:
-                        raise ValueError("Bad dictionary link: %s" % self.source)
-            finally:
-                MultiParser.CacheLock.release()
-            try:
-                return [term for term in dictionary.entries if term.key == raw_value].pop(0)
-            except IndexError:
-                logging.error('Key "%s" missing in dictionary "%s".' %
-                              (raw_value, self.source))
+            return self._lookup(MultiParser.DictionaryCache.get(self.source, client), raw_value)
+
+    def convert_many(self, raw_values, client):
+        """
+        Perform the conversion of :meth:`convert` on a list of values. The
+        dictionary is only looked up once for the whole list.
 
+        Args:
+            raw_values (list): The raw strings to parse
+            client (vizone.client.Instance): The HTTP client to use when looking up dictionary terms.
+
+        Returns:
+            list: The converted values, in the same order
+        """
+        if self.type != "dictionary":
+            return [self.convert(raw_value, client) for raw_value in raw_values]
+        if not any(raw_value for raw_value in raw_values):
+            return [None] * len(raw_values)
+        index = MultiParser.DictionaryCache.get(self.source, client)
+        return [self._lookup(index, raw_value) if raw_value else None
+                for raw_value in raw_values]
+
+    def _lookup(self, index, raw_value):
+        term = index.lookup(self.aliases.get(raw_value, raw_value), self.ignore_case)
+        if term is None:
+            logging.error('Key "%s" missing in dictionary "%s".' %
+                          (raw_value, self.source))
+        return term
+
+    def _convert_timestamp(self, raw_value):
+        if self.type == "iso":
+            return Timestamp(raw_value)
+        elif self.type == "date":
+            return Timestamp(self._parse(raw_value).date().isoformat())
+        elif self.type == "time":
+            return Timestamp(self._parse(raw_value).time().isoformat())
+        d = self._parse(raw_value)
+        t = Timestamp(d.isoformat())
+        if not t.has_tz():
+            t = t.assume(self.default_timezone)
+        return t.utc()
@@ -1,33 +1,455 @@
-from threading import Lock
+import os
+import time
+import uuid
+import errno
+import socket
+import hashlib
+import collections
+from threading import Lock, Event, Thread
+from vizone import logging
 
+try:
+    import fcntl
+except ImportError:
+    _have_fcntl = False
+else:
+    _have_fcntl = True
 
-_locks = {}
-_internal_lock = Lock()
 
+class LockTimeout(Exception):
+    """
+    Raised by :class:`Locked` when the lock could not be acquired in time.
+    """
+    pass
 
-def _lock(key):
-    with _internal_lock:
-        lock = _locks.get(key) or Lock()
 
-    lock.acquire()
+class _Entry(object):
+    __slots__ = ('held', 'refs', 'waiters', 'acquired')
 
-    with _internal_lock:
-        if not key in _locks:
-            _locks[key] = lock
+    def __init__(self):
+        self.held = False
+        self.refs = 0
+        self.waiters = collections.deque()
+        self.acquired = None
 
 
-def _unlock(key):
-    with _internal_lock:
-        lock = _locks.get(key)
+class KeyStatistics(object):
+    """
+    Wait and hold times for one key, in seconds.
+    """
+    __slots__ = ('count', 'contended', 'timeouts', 'total_wait', 'max_wait',
+                 'total_hold', 'max_hold')
+
+    def __init__(self):
+        self.count = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+        self.total_hold = 0.
+        self.max_hold = 0.
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'contended': self.contended,
+            'timeouts': self.timeouts,
+            'wait mean': self.total_wait / self.count if self.count else None,
+            'wait max': self.max_wait,
+            'hold mean': self.total_hold / self.count if self.count else None,
+            'hold max': self.max_hold,
+        }
+
+
+class LockRegistry(object):
+    """
+    Registry of locks by key. A key's lock exists as long as some thread
+    holds or waits for it, and is handed over to waiting threads in the
+    order they came (first-in-first-out).
+
+    Wait and hold times are recorded in total and for the ``max_keys`` most
+    recently used keys.
+    """
+    def __init__(self, max_keys=1000):
+        self._lock = Lock()
+        self._entries = {}
+        self.max_keys = max_keys
+        self.total = KeyStatistics()
+        self.keys = collections.OrderedDict()
+
+    def _key_stats(self, key):
+        stats = self.keys.pop(key, None) or KeyStatistics()
+        self.keys[key] = stats
+        if len(self.keys) > self.max_keys:
+            self.keys.popitem(last=False)
+        return stats
+
+    def _granted(self, key, entry, wait, contended):
+        entry.acquired = time.time()
+        for stats in (self.total, self._key_stats(key)):
+            stats.count += 1
+            stats.contended += int(contended)
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+
+    def _forget(self, key, entry):
+        entry.refs -= 1
+        if entry.refs == 0:
+            del self._entries[key]
+
+    def acquire(self, key, blocking=True, timeout=None):
+        """
+        Acquire the lock for ``key``.
+
+        Args:
+            key (unicode): The key to lock
+            blocking (bool): Wait for the lock if it is held by another thread
+            timeout (float): Wait at most this many seconds (``None`` is forever)
+
+        Returns:
+            bool: True if the lock was acquired
+        """
+        start_time = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+            entry.refs += 1
+
+            if not entry.held:
+                entry.held = True
+                self._granted(key, entry, 0., False)
+                return True
+
+            if not blocking:
+                self._forget(key, entry)
+                return False
+
+            waiter = Event()
+            entry.waiters.append((waiter, start_time))
+
+        if waiter.wait(timeout) or timeout is None:
+            return True
+
+        with self._lock:
+            # The lock may have been handed over just after time out
+            if waiter.is_set():
+                return True
+            entry.waiters.remove((waiter, start_time))
+            self._forget(key, entry)
+            self.total.timeouts += 1
+            self._key_stats(key).timeouts += 1
+            return False
+
+    def release(self, key):
+        """
+        Release the lock for ``key``, handing it over to the next waiting
+        thread if any. Releasing a key that is not locked does nothing.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not entry.held:
+                logging.warn("Release of unlocked key %s.", repr(key))
+                return
+
+            hold = time.time() - entry.acquired
+            for stats in (self.total, self._key_stats(key)):
+                stats.total_hold += hold
+                stats.max_hold = max(stats.max_hold, hold)
+
+            self._forget(key, entry)
+            if entry.waiters:
+                waiter, start_time = entry.waiters.popleft()
+                self._granted(key, entry, time.time() - start_time, True)
+                waiter.set()
+            else:
+                entry.held = False
+
+    def locked(self, key):
+        """
+        Returns:
+            bool: True if the lock for ``key`` is currently held
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry.held
+
+    def statistics(self, key=None):
+        """
+        Get wait and hold times for a ``key``, or in total if no key given.
+
+        Returns:
+            dict: See :class:`KeyStatistics`, or ``None`` for unknown keys
+        """
+        with self._lock:
+            if key is None:
+                stats = self.total.as_dict()
+                stats['keys held'] = len(self._entries)
+                return stats
+            stats = self.keys.get(key)
+            return stats.as_dict() if stats is not None else None
+
+
+def _remaining(deadline):
+    return None if deadline is None else max(0., deadline - time.time())
+
+
+def _same_file(f, path):
+    try:
+        opened, current = os.fstat(f.fileno()), os.stat(path)
+    except OSError:
+        return False
+    return (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino)
+
+
+class FileLockBackend(object):
+    """
+    Lock backend that also locks between processes on the same machine,
+    using ``flock`` on one file per key in ``directory``. Threads within the
+    process are first serialized by a :class:`LockRegistry`, which also keeps
+    the statistics.
+
+    A lock file is removed again when its lock is released, so the directory
+    only holds the files of keys that are locked or waited for.
+    """
+    def __init__(self, directory):
+        assert _have_fcntl, "FileLockBackend requires fcntl"
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.registry = LockRegistry()
+        self._files = {}
+
+    def _path(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + '.lock')
+
+    def _flock(self, f, blocking, deadline):
+        if blocking and deadline is None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            return True
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                if not blocking or _remaining(deadline) == 0:
+                    return False
+                time.sleep(min(0.05, _remaining(deadline)))
+
+    def acquire(self, key, blocking=True, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        if not self.registry.acquire(key, blocking, timeout):
+            return False
+
+        path = self._path(key)
+        try:
+            while True:
+                f = open(path, 'a')
+                try:
+                    locked = self._flock(f, blocking, deadline)
+                except Exception:
+                    f.close()
+                    raise
+                # The file may have been removed by the holder releasing it,
+                # then the lock is on the new file
+                if locked and _same_file(f, path):
+                    break
+                f.close()
+                if not locked:
+                    self.registry.release(key)
+                    return False
+        except Exception:
+            self.registry.release(key)
+            raise
+
+        self._files[key] = f
+        return True
 
-    if lock is None:
-        return
+    def release(self, key):
+        f = self._files.pop(key, None)
+        if f is None:
+            logging.warn("Release of unlocked key %s.", repr(key))
+            return
+        try:
+            # Removed while still locked, so no one else holds the lock of
+            # the same path at the same time
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            f.close()
+            self.registry.release(key)
 
-    lock.release()
+    def statistics(self, key=None):
+        return self.registry.statistics(key)
 
-    with _internal_lock:
-        if key in _locks:
-            del _locks[key]
+
+class LockService(object):
+    """
+    Interface for a shared lock service, for locking between processes on
+    several machines. Locks are leases that expire unless renewed, so that
+    a crashed process does not hold its keys forever.
+    """
+    def acquire(self, key, owner, lease):
+        """
+        Try to take the lease of ``key`` for ``owner`` for ``lease`` seconds.
+
+        Returns:
+            bool: True if taken, False if held by another owner
+        """
+        raise NotImplementedError
+
+    def renew(self, key, owner, lease):
+        """
+        Extend the lease of ``key`` held by ``owner`` to ``lease`` seconds
+        from now.
+
+        Returns:
+            bool: False if ``owner`` no longer holds the lease
+        """
+        raise NotImplementedError
+
+    def release(self, key, owner):
+        """
+        Give up the lease of ``key`` held by ``owner``.
+        """
+        raise NotImplementedError
+
+
+class LocalLockService(LockService):
+    """
+    In-memory :class:`LockService`, as a stand-in for a shared one when
+    running a single process, and for testing.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._leases = {}
+
+    def acquire(self, key, owner, lease):
+        now = time.time()
+        with self._lock:
+            holder = self._leases.get(key)
+            if holder is not None and holder[0] != owner and holder[1] > now:
+                return False
+            self._leases[key] = (owner, now + lease)
+            return True
+
+    def renew(self, key, owner, lease):
+        with self._lock:
+            holder = self._leases.get(key)
+            if holder is None or holder[0] != owner:
+                return False
+            self._leases[key] = (owner, time.time() + lease)
+            return True
+
+    def release(self, key, owner):
+        with self._lock:
+            holder = self._leases.get(key)
+            if holder is not None and holder[0] == owner:
+                del self._leases[key]
+
+
+class ServiceLockBackend(object):
+    """
+    Lock backend using a :class:`LockService`. Threads within the process
+    are first serialized by a :class:`LockRegistry`; the process then polls
+    the service every ``poll`` seconds until it gets the lease. Leases of
+    held keys are renewed every third of ``lease`` seconds.
+    """
+    def __init__(self, service, lease=30, poll=0.1):
+        self.service = service
+        self.lease = lease
+        self.poll = poll
+        self.owner = '%s:%i:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.registry = LockRegistry()
+        self._held = set()
+        self._held_lock = Lock()
+
+        renewer = Thread(target=self._renew, name='lock_lease_renewer')
+        renewer.daemon = True
+        renewer.start()
+
+    def _renew(self):
+        while True:
+            time.sleep(self.lease / 3.)
+            with self._held_lock:
+                keys = list(self._held)
+            for key in keys:
+                try:
+                    if not self.service.renew(key, self.owner, self.lease):
+                        logging.error("Lost the lease of lock %s.", repr(key))
+                except Exception as e:
+                    logging.error("Could not renew the lease of lock %s: %s", repr(key), str(e))
+
+    def acquire(self, key, blocking=True, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        if not self.registry.acquire(key, blocking, timeout):
+            return False
+
+        try:
+            while not self.service.acquire(key, self.owner, self.lease):
+                remaining = _remaining(deadline)
+                if not blocking or remaining == 0:
+                    self.registry.release(key)
+                    return False
+                time.sleep(self.poll if remaining is None else min(self.poll, remaining))
+        except Exception:
+            self.registry.release(key)
+            raise
+
+        with self._held_lock:
+            self._held.add(key)
+        return True
+
+    def release(self, key):
+        with self._held_lock:
+            if key not in self._held:
+                logging.warn("Release of unlocked key %s.", repr(key))
+                return
+            self._held.discard(key)
+        try:
+            self.service.release(key, self.owner)
+        finally:
+            self.registry.release(key)
+
+    def statistics(self, key=None):
+        return self.registry.statistics(key)
+
+
+_backend = LockRegistry()
+
+
+def set_backend(backend):
+    """
+    Set the backend used by :class:`Locked`, for instance a
+    :class:`FileLockBackend` to lock between processes. The default is a
+    :class:`LockRegistry`, which only locks between threads. Set this before
+    any locks are taken.
+    """
+    global _backend
+    _backend = backend
+
+
+def _lock(key, blocking=True, timeout=None):
+    return _backend.acquire(key, blocking, timeout)
+
+
+def _unlock(key):
+    _backend.release(key)
+
+
+def statistics(key=None):
+    """
+    Get wait and hold times of :class:`Locked` for a ``key``, or in total.
+    See :meth:`LockRegistry.statistics`.
+    """
+    return _backend.statistics(key)
 
 
 class Locked(object):
@@ -44,16 +466,24 @@ class Locked(object):
             # .. do stuff
 
     Only one process per key can be run simultaneously, other attempt
-    will be held until the lock is released.
+    will be held until the lock is released, in the order they came. By
+    default this only holds for threads within the process, see
+    :func:`flow.lock.set_backend` to lock between processes.
+
+    With ``timeout`` (seconds) or ``blocking=False``, a
+    :class:`LockTimeout` is raised if the lock could not be acquired in
+    time. Wait and hold times are available from
+    :func:`flow.lock.statistics`.
     """
-    def __init__(self, key):
+    def __init__(self, key, blocking=True, timeout=None):
         self.key = key
+        self.blocking = blocking
+        self.timeout = timeout
 
     def __enter__(self):
-        _lock(self.key)
+        if not _lock(self.key, self.blocking, self.timeout):
+            raise LockTimeout("Could not lock %s" % repr(self.key))
         return self
 
     def __exit__(self, type, value, traceback):
         _unlock(self.key)
-
-
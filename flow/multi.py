@@ -1,110 +1,1248 @@
+import os
 import threading
 import time
+import math
+import bisect
+import heapq
+import itertools
+import collections
+import traceback
+import multiprocessing
+import cPickle as pickle
+import Queue
 from vizone import logging
+from vizone.classutils import to_class
+
+
+def with_local_log_id(worker):
+    """
+    Wrap ``worker`` so that the ``logger`` and ``log_id`` keyword arguments
+    are consumed and used to set the thread-local log id before the call.
+    """
+    def wrapped(*args, **kwargs):
+        try:
+            logger = kwargs.pop('logger')
+            log_id = kwargs.pop('log_id')
+            logger.set_log_id(log_id)
+        except KeyError:
+            pass
+        except AttributeError:
+            pass
+
+        return worker(*args, **kwargs)
+
+    return wrapped
+
+
+class Histogram(object):
+    """
+    Bounded histogram of durations in seconds, with logarithmic buckets from
+    ``low`` to ``high``. Memory use is constant regardless of the number of
+    values added; percentiles are accurate to the bucket resolution (about
+    12% with the default 20 buckets per decade).
+    """
+    def __init__(self, low=0.001, high=86400., buckets_per_decade=20):
+        decades = math.log10(high / low)
+        count = int(math.ceil(decades * buckets_per_decade))
+        self.bounds = [low * 10 ** (float(n) / buckets_per_decade) for n in range(count + 1)]
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += 1
+
+    def percentile(self, p):
+        """
+        Get the upper bound of the bucket holding the ``p``:th percentile
+        (0-100), or ``None`` if there are no values.
+        """
+        if self.total == 0:
+            return None
+        rank = max(1, int(math.ceil(self.total * p / 100.)))
+        seen = 0
+        for n, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds[min(n, len(self.bounds) - 1)]
+
+
+class Statistics(object):
+    """
+    Thread-safe task statistics for a pool: counts of tasks, failures and
+    timeouts, and histograms of queue-wait time and run time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_wait = 0.
+        self.total_run = 0.
+        self.wait_time = Histogram()
+        self.run_time = Histogram()
+
+    def record(self, wait, run, failed=False, timed_out=False):
+        with self.lock:
+            self.count += 1
+            self.failures += int(failed)
+            self.timeouts += int(timed_out)
+            self.total_wait += wait
+            self.total_run += run
+            self.wait_time.add(wait)
+            self.run_time.add(run)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: The current figures, times are in seconds
+        """
+        with self.lock:
+            count = self.count
+            return {
+                'count': count,
+                'failures': self.failures,
+                'timeouts': self.timeouts,
+                'wait mean': self.total_wait / count if count else None,
+                'wait p50': self.wait_time.percentile(50),
+                'wait p95': self.wait_time.percentile(95),
+                'wait p99': self.wait_time.percentile(99),
+                'run mean': self.total_run / count if count else None,
+                'run p50': self.run_time.percentile(50),
+                'run p95': self.run_time.percentile(95),
+                'run p99': self.run_time.percentile(99),
+            }
+
+
+class Task(object):
+    """
+    A unit of work waiting in, or being run by, a :class:`Pool`.
+    """
+    def __init__(self, worker, args, kwargs, priority=0):
+        self.worker = worker
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.name = 'task_%s' % str(kwargs.get('log_id', 'x'))
+        self.queued = time.time()
+        self.started = None
+        self.deadline = None
+        self.overdue = False
+        self.counted = True  # recorded in the pool statistics when done
+
+    def run(self):
+        return with_local_log_id(self.worker)(*self.args, **self.kwargs)
+
+
+_local = threading.local()
+
+
+def current_task():
+    """
+    Get the :class:`Task` run by the current worker thread, or ``None`` if
+    not called from within a task.
+    """
+    return getattr(_local, 'task', None)
+
+
+def remaining_time(default=None):
+    """
+    Get the number of seconds left until the deadline of the current task,
+    for instance to use as time out for HTTP calls:
+
+        self.client.GET(url, timeout=remaining_time(60))
+
+    The calls of :class:`flow.store.Store` use it already. Returns
+    ``default`` if not called from within a task with a deadline, which
+    includes coroutines run by :class:`flow.aio.EventLoopPool`.
+    """
+    task = current_task()
+    if task is None or task.deadline is None:
+        return default
+    return max(0., task.deadline - time.time())
 
 
 class Pool(object):
-    def __init__(self, workers=1, join=True, timeout=60):
-        logging.info("Create pool with %i workers (%s, timeout=%i).",
-                     workers, 'join' if join else 'no join', timeout)
+    """
+    Pool of long-lived worker threads pulling tasks from a bounded queue.
+
+    Use like this:
+
+        with Pool(workers=4) as pool:
+            pool.spawn(flow.start, obj, logger=logger, log_id=log_id)
+
+    ``spawn`` blocks when ``queue_size`` tasks (defaults to ``workers``) are
+    already waiting for a free worker.
+
+    Queued tasks are run in order of the ``priority`` keyword given to
+    ``spawn`` (higher first, default 0), and first-in-first-out for equal
+    priorities. To keep low priority tasks from starving, a waiting task
+    gains ``aging`` priority per second it has been queued.
+
+    Every task gets a deadline ``timeout`` seconds after it is started, which
+    the task can read with :func:`remaining_time` (to pass on as an HTTP time
+    out for instance). Tasks running past their deadline are counted as
+    overdue. The ``overdue`` policy decides what happens with their worker:
+
+    - ``hold``: the overdue task keeps its worker, so no more than
+      ``workers`` tasks ever run at the same time
+    - ``replace``: a replacement worker is started and the overdue one
+      retires once its task is done, but never more than ``max_overdue``
+      (defaults to ``workers``) overdue tasks are replaced at a time
+
+    If ``max_workers`` is larger than ``min_workers`` (both default to
+    ``workers``), the pool starts at ``workers`` (brought within those
+    bounds) and the number of workers is adjusted every ``scale_interval``
+    seconds: one is added while tasks are waiting and all workers are busy,
+    and one is removed while some are idle.
+    The pool also shrinks when more than ``max_error_rate`` of the recent
+    tasks failed, or their mean run time is more than ``latency_factor``
+    times the usual, to back off when the server is struggling.
+
+    Task statistics are kept in ``stats`` (see :meth:`statistics`) and logged
+    every ``stats_interval`` seconds (0 to only log on exit).
+
+    To shut down without losing tasks that are already queued, call
+    :meth:`drain` before leaving the ``with`` block. ``spawn`` returns
+    ``False`` once the pool is draining, as the task is then not queued.
+    """
+    OverduePolicies = {"hold", "replace"}
+
+    def __init__(self, workers=1, join=True, timeout=60, queue_size=None, stats_interval=60,
+                 overdue="hold", max_overdue=None, aging=0., min_workers=None, max_workers=None,
+                 scale_interval=5, max_error_rate=0.1, latency_factor=2.):
+        assert overdue in Pool.OverduePolicies, "Overdue policy %s is not in %s" % (
+                overdue, str(Pool.OverduePolicies))
+        min_workers = max(1, workers if min_workers is None else min_workers)
+        max_workers = max(min_workers, workers if max_workers is None else max_workers)
+        workers = min(max(workers, min_workers), max_workers)
+        logging.info("Create pool with %i workers (%s, timeout=%i, overdue=%s).",
+                     workers, 'join' if join else 'no join', timeout, overdue)
         self.start_time = time.time()
 
         self.worker_count = workers
         self.join = join
         self.timeout = timeout
+        self.overdue = overdue
+        self.max_overdue = workers if max_overdue is None else max_overdue
+        self.aging = aging
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.scale_interval = scale_interval
+        self.max_error_rate = max_error_rate
+        self.latency_factor = latency_factor
 
-        self.resource = threading.BoundedSemaphore(workers)
+        self.queue = Queue.PriorityQueue(queue_size or workers)
+        self.sequence = itertools.count()
+        self.stats = Statistics()
+        self.stopped = threading.Event()
+        self.draining = False
+        _start_reporter(self, stats_interval)
 
         self.threads_lock = threading.Lock()
         self.threads = {}
+        self.thread_count = 0
+        self.running = {}
+        self.retired = set()
+        for _ in range(workers):
+            self._add_worker()
 
-        self.timing_lock = threading.Lock()
-        self.counter = 0
-        self.avg_time = 0
+        watchdog = threading.Thread(target=self._watch, name='pool_watchdog')
+        watchdog.daemon = True
+        watchdog.start()
+
+        if self.max_workers > self.min_workers:
+            logging.info("Scale pool between %i and %i workers.",
+                         self.min_workers, self.max_workers)
+            scaler = threading.Thread(target=self._scale, name='pool_scaler')
+            scaler.daemon = True
+            scaler.start()
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
         logging.debug("Exit pool.")
-        if self.join:
-            for thread in self.threads.values():
+        if self.join and not self.draining:
+            with self.threads_lock:
+                threads = [thread for name, thread in self.threads.items()
+                           if name not in self.retired]
+            for _ in threads:
+                self._put(None)
+            for thread in threads:
                 thread.join(self.timeout)
                 logging.debug("Exit joined %s. (%s)", thread.name,
                         "timed out" if thread.is_alive() else "ok")
+        elif self.draining:
+            for _ in range(len(self.threads)):
+                try:
+                    self._put(None, block=False)
+                except Queue.Full:
+                    break
+        self.stopped.set()
         total_time = time.time() - self.start_time
         logging.info("Ran %i tasks in %f seconds (avg %f seconds per task).",
-                self.counter, total_time, self.avg_time)
+                self.stats.count, total_time,
+                self.stats.total_run / max(self.stats.count, 1))
+        logging.log("Pool statistics", self.statistics(), 'pp')
 
-    def _control(self, thread):
-        try:
-            logging.debug("Start control thread for %s.", thread.name)
-            start_time = time.time()
-            thread.start()
-            thread.join(self.timeout)
-            end_time = time.time()
-            logging.debug("Control thread joined %s. (%s)", thread.name,
-                    "timed out" if thread.is_alive() else "ok")
+    def statistics(self):
+        """
+        Get the current task statistics of the pool.
 
-            with self.timing_lock:
-                self.avg_time = (self.avg_time + (end_time - start_time)) / 2
+        Returns:
+            dict: See :meth:`Statistics.snapshot`, plus the queue depth and
+                  the number of running and overdue tasks
+        """
+        stats = self.stats.snapshot()
+        stats['queue depth'] = self.queue.qsize()
+        with self.threads_lock:
+            stats['workers'] = self.worker_count
+            stats['running'] = len(self.running)
+            stats['overdue'] = len([task for task in self.running.values() if task.overdue])
+        return stats
 
+    def _add_worker(self):
+        with self.threads_lock:
+            name = 'worker_%i' % self.thread_count
+            self.thread_count += 1
+            thread = threading.Thread(target=self._work, name=name)
+            thread.daemon = True
+            self.threads[name] = thread
+        thread.start()
+
+    def _work(self):
+        name = threading.current_thread().name
+        logging.debug("Start worker thread %s.", name)
+        try:
+            while True:
+                _, _, task = self.queue.get()
+                try:
+                    if task is None:
+                        return
+                    self._run(name, task)
+                finally:
+                    self.queue.task_done()
+                with self.threads_lock:
+                    if name in self.retired:
+                        return
+        finally:
+            with self.threads_lock:
+                del self.threads[name]
+                self.retired.discard(name)
+            logging.debug("Exit worker thread %s.", name)
+
+    def _run(self, name, task):
+        logging.debug("Run %s.", task.name)
+        task.started = time.time()
+        task.deadline = task.started + self.timeout
+        with self.threads_lock:
+            self.running[name] = task
+        _local.task = task
+        failed = False
+        try:
+            task.run()
+        except Exception:
+            failed = True
+            logging.log("Task %s failed" % task.name, traceback.format_exc(), 'error')
         finally:
+            _local.task = None
+            with self.threads_lock:
+                del self.running[name]
+        end_time = time.time()
+        timed_out = end_time > task.deadline
+        logging.debug("Done with %s. (%s)", task.name,
+                "timed out" if timed_out else "ok")
+
+        if task.counted:
+            self.stats.record(task.started - task.queued, end_time - task.started,
+                              failed=failed, timed_out=timed_out)
+
+    def _watch(self):
+        while not self.stopped.wait(min(1., self.timeout / 4.)):
+            now = time.time()
+            replace = 0
+            with self.threads_lock:
+                for name, task in self.running.items():
+                    if task.overdue or now <= task.deadline:
+                        continue
+                    task.overdue = True
+                    logging.warn("Task %s is overdue (running for %f seconds).",
+                                 task.name, now - task.started)
+                    if self.overdue == "replace" and len(self.retired) < self.max_overdue:
+                        self.retired.add(name)
+                        replace += 1
+            for _ in range(replace):
+                self._add_worker()
+
+    def drain(self, grace=30):
+        """
+        Stop taking on new tasks and wait at most ``grace`` seconds for
+        the queued and running ones to finish. Tasks still queued after
+        that are thrown away.
+
+        Returns:
+            tuple: (number of completed tasks, number of abandoned tasks)
+        """
+        logging.info("Draining pool (%i queued, grace period %f seconds)...",
+                     self.queue.qsize(), grace)
+        self.draining = True
+        deadline = time.time() + grace
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.1)
+
+        abandoned = 0
+        while True:
             try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.queue.task_done()
+            abandoned += 1
+        with self.threads_lock:
+            abandoned += len(self.running)
+        return self.stats.count, abandoned
+
+    def _scale(self):
+        last = {'count': 0, 'failures': 0, 'total run': 0.}
+        usual_run = None
+        while not self.stopped.wait(self.scale_interval):
+            if self.draining:
+                return
+            with self.stats.lock:
+                count = self.stats.count - last['count']
+                failures = self.stats.failures - last['failures']
+                run = self.stats.total_run - last['total run']
+                last = {
+                    'count': self.stats.count,
+                    'failures': self.stats.failures,
+                    'total run': self.stats.total_run,
+                }
+            mean_run = run / count if count else None
+            error_rate = float(failures) / count if count else 0.
+
+            struggling = False
+            if error_rate > self.max_error_rate:
+                struggling = True
+                logging.warn("Error rate %f is too high.", error_rate)
+            elif mean_run is not None:
+                if usual_run is not None and mean_run > self.latency_factor * usual_run:
+                    struggling = True
+                    logging.warn("Task run time %f is much higher than usual (%f).",
+                                 mean_run, usual_run)
+                # Follow improvements directly but deteriorations slowly
+                if usual_run is None or mean_run < usual_run:
+                    usual_run = mean_run
+                else:
+                    usual_run += (mean_run - usual_run) * 0.05
+
+            with self.threads_lock:
+                workers = self.worker_count
+                idle = workers - len(self.running)
+            waiting = self.queue.qsize()
+
+            if (struggling or (idle > 0 and waiting == 0)) and workers > self.min_workers:
+                # Jump the queue, so the next free worker leaves
+                try:
+                    self._put(None, block=False, first=True)
+                except Queue.Full:
+                    continue
+                with self.threads_lock:
+                    self.worker_count -= 1
+                logging.info("Scaled pool down to %i workers.", workers - 1)
+            elif not struggling and idle == 0 and waiting > 0 and workers < self.max_workers:
                 with self.threads_lock:
-                    del self.threads[thread.name]
+                    self.worker_count += 1
+                self._add_worker()
+                logging.info("Scaled pool up to %i workers.", workers + 1)
 
-            finally:
-                self.resource.release()
-                logging.debug("Exit control thread for %s.", thread.name)
+    def _put(self, task, block=True, first=False):
+        # Since all waiting tasks age at the same rate, ordering them by
+        # aging * queued - priority is the same as ordering by their
+        # current, aged, priority. Stop signals (None) go last unless
+        # ``first`` is given.
+        if task is None:
+            key = float('-inf') if first else float('inf')
+        else:
+            key = self.aging * (task.queued - self.start_time) - task.priority
+        self.queue.put((key, next(self.sequence), task), block)
 
     def spawn(self, worker, *args, **kwargs):
         logging.debug("Start spawn.")
+        priority = kwargs.pop('priority', 0)
+        task = Task(worker, args, kwargs, priority)
+        if self.draining:
+            logging.warn("Pool is draining, not running %s.", task.name)
+            return False
+        self._put(task)
+        logging.debug("Queued %s (priority %s).", task.name, str(priority))
+        return True
+
+
+def serialize(obj):
+    """
+    Turn an event object into something that can be shipped to a worker
+    process. Payload objects (anything with a ``generate`` method) are sent
+    as their XML together with their class, everything else is pickled.
+    """
+    if hasattr(obj, 'generate'):
+        klass = obj.__class__
+        return ('payload', '%s.%s' % (klass.__module__, klass.__name__), obj.generate())
+    return ('pickle', None, pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+
+def deserialize(data):
+    """
+    Reverse of :func:`serialize`.
+    """
+    kind, class_name, body = data
+    if kind == 'payload':
+        return to_class(class_name)(body)
+    return pickle.loads(body)
+
+
+# The flow instance owned by a worker process, set up by _process_init
+_process_flow = None
+
+
+def _process_init(setup, setup_args):
+    global _process_flow
+    _process_flow = setup(*setup_args)
+
+
+def _process_run(method_name, data, log_id, timeout):
+    # Never raises, the pool only learns about finished tasks through the
+    # result, so a task that fails in any way must still report back
+    started = time.time()
+    try:
+        logging.get_default_logger().set_log_id(log_id)
+        task = Task(getattr(_process_flow, method_name), (deserialize(data), ), {})
+        task.started = started
+        task.deadline = started + timeout
+        _local.task = task
+        task.run()
+        failed = False
+    except Exception:
+        logging.log("Task %s failed" % log_id, traceback.format_exc(), 'error')
+        failed = True
+    finally:
+        _local.task = None
+    return failed, time.time() - started
+
+
+def _start_reporter(pool, interval, title="Pool statistics"):
+    if not interval:
+        return
+
+    def report():
+        while not pool.stopped.wait(interval):
+            logging.log(title, pool.statistics(), 'pp')
+
+    thread = threading.Thread(target=report, name='pool_statistics')
+    thread.daemon = True
+    thread.start()
+
+
+class ProcessPool(object):
+    """
+    Pool of worker processes, for flows that are CPU-bound.
+
+    Each process calls ``setup(*setup_args)`` once when started, which must
+    return the (equipped) flow object to use in that process. Tasks are then
+    given as a bound method of the flow in the parent process and a single
+    event object, which is shipped to the worker in serialized form (see
+    :func:`serialize`):
+
+        with ProcessPool(workers=4, setup=make_flow) as pool:
+            pool.spawn(flow.start, obj, logger=logger, log_id=log_id)
+
+    ``spawn`` blocks when ``queue_size`` tasks (defaults to ``workers``) are
+    already waiting for a free worker. Statistics are kept like for
+    :class:`Pool`. Tasks are run first-in-first-out, any ``priority`` given
+    to ``spawn`` is ignored.
+    """
+    def __init__(self, workers=1, setup=None, setup_args=(), join=True, timeout=60, queue_size=None,
+                 stats_interval=60):
+        logging.info("Create process pool with %i workers (%s, timeout=%i).",
+                     workers, 'join' if join else 'no join', timeout)
+        self.start_time = time.time()
+
+        self.worker_count = workers
+        self.join = join
+        self.timeout = timeout
+
+        self.resource = threading.BoundedSemaphore(workers + (queue_size or workers))
+        self.pool = multiprocessing.Pool(workers, _process_init, (setup, setup_args))
+
+        self.pending_lock = threading.Lock()
+        self.pending = 0
+        self.draining = False
+        self.stats = Statistics()
+        self.stopped = threading.Event()
+        _start_reporter(self, stats_interval)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        logging.debug("Exit process pool.")
+        self.pool.close()
+        if self.join and not self.draining:
+            self.pool.join()
+        else:
+            self.pool.terminate()
+        self.stopped.set()
+        total_time = time.time() - self.start_time
+        logging.info("Ran %i tasks in %f seconds.", self.stats.count, total_time)
+        logging.log("Pool statistics", self.statistics(), 'pp')
+
+    def statistics(self):
+        """
+        Get the current task statistics of the pool.
+
+        Returns:
+            dict: See :meth:`Statistics.snapshot`, plus the queue depth
+        """
+        stats = self.stats.snapshot()
+        with self.pending_lock:
+            stats['queue depth'] = max(0, self.pending - self.worker_count)
+        return stats
+
+    def _done(self, queued, result):
+        failed, run_time = result
+        total_time = time.time() - queued
+        self.stats.record(max(0., total_time - run_time), run_time,
+                          failed=failed, timed_out=run_time > self.timeout)
+        with self.pending_lock:
+            self.pending -= 1
+        self.resource.release()
+
+    def drain(self, grace=30):
+        """
+        Stop taking on new tasks and wait at most ``grace`` seconds for
+        the queued and running ones to finish. Worker processes are
+        terminated after that.
+
+        Returns:
+            tuple: (number of completed tasks, number of abandoned tasks)
+        """
+        logging.info("Draining process pool (grace period %f seconds)...", grace)
+        self.draining = True
+        self.pool.close()
+        deadline = time.time() + grace
+        while self.pending and time.time() < deadline:
+            time.sleep(0.1)
+        with self.pending_lock:
+            abandoned = self.pending
+        self.pool.terminate()
+        return self.stats.count, abandoned
+
+    def spawn(self, worker, obj, **kwargs):
+        logging.debug("Start spawn.")
+        if self.draining:
+            logging.warn("Process pool is draining, not running task_%s.",
+                         str(kwargs.get('log_id', 'x')))
+            return False
         self.resource.acquire()
-        logging.debug("Acquired resource.")
+        with self.pending_lock:
+            self.pending += 1
+        kwargs.pop('priority', None)
+        log_id = kwargs.get('log_id', 'x')
+        queued = time.time()
+        try:
+            self.pool.apply_async(
+                _process_run,
+                (worker.__name__, serialize(obj), log_id, self.timeout),
+                callback=lambda result: self._done(queued, result),
+            )
+        except Exception:
+            # Could not be sent to a worker, count it as failed right away
+            logging.log("Task task_%s failed" % str(log_id), traceback.format_exc(), 'error')
+            self._done(queued, (True, 0.))
+            return True
+        logging.debug("Queued task_%s.", str(log_id))
+        return True
 
-        def with_local_log_id(worker):
-            def wrapped(*args, **kwargs):
-                try:
-                    logger = kwargs.pop('logger')
-                    log_id = kwargs.pop('log_id')
-                    logger.set_log_id(log_id)
-                except KeyError:
-                    pass
-                except AttributeError:
-                    pass
-
-                return worker(*args, **kwargs)
-
-            return wrapped
-        
-        log_id = str(kwargs.get('log_id', 'x'))
-        worker_thread = threading.Thread(
-            target=with_local_log_id(worker),
-            name='worker_%s' % log_id,
-            args=args,
-            kwargs=kwargs,
-        )
-        worker_thread.daemon = True
-
-        control_thread = threading.Thread(
-            target=self._control,
-            name='control_%s' % log_id,
-            args=(worker_thread, ),
-        )
-        control_thread.daemon = True
 
-        with self.threads_lock:
-            self.threads[worker_thread.name] = control_thread
+class Intake(object):
+    """
+    Bounded queue between a source and a pool. The source hands over events
+    with ``put``, and a separate intake thread passes them on to
+    ``dispatch`` (typically something calling ``pool.spawn``), so that
+    a source's listener thread is not held up by a busy pool.
+
+    What happens when ``size`` events are already waiting depends on
+    ``policy``:
+
+    - ``block``: ``put`` waits until there is room
+    - ``drop-oldest``: the oldest waiting event is discarded
+    - ``spill``: the event is serialized (see :func:`serialize`) to a file
+      in ``spill_dir`` and read back in order when the queue has room.
+      The file is removed once the event has been dispatched, and events
+      left in ``spill_dir`` are picked up again on start.
+
+    An event counts as dispatched when ``dispatch`` returns anything but
+    ``False`` (as :meth:`Pool.spawn` does when draining) without raising.
+
+    Use like this:
+
+        with Intake(work, size=1000, policy='drop-oldest') as intake:
+            source.callback = intake.put
+    """
+    Policies = {"block", "drop-oldest", "spill"}
+
+    def __init__(self, dispatch, size=1000, policy="block", spill_dir=None, stats_interval=60):
+        assert policy in Intake.Policies, "Intake policy %s is not in %s" % (
+                policy, str(Intake.Policies))
+        assert policy != "spill" or spill_dir, "Intake policy spill requires spill_dir"
+
+        logging.info("Create intake for %i events (%s).", size, policy)
+        self.dispatch = dispatch
+        self.size = size
+        self.policy = policy
+        self.spill_dir = spill_dir
+
+        self.queue = collections.deque()
+        self.spilled = collections.deque()
+        self.spill_count = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.halted = False
+
+        self.received = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.refused = 0
+        self.spills = 0
+        self.max_depth = 0
+
+        if self.policy == "spill":
+            if not os.path.isdir(self.spill_dir):
+                os.makedirs(self.spill_dir)
+            self.spilled.extend(sorted(
+                os.path.join(self.spill_dir, name)
+                for name in os.listdir(self.spill_dir) if name.endswith('.spill')
+            ))
+            if self.spilled:
+                logging.info("Found %i spilled events in %s.", len(self.spilled), self.spill_dir)
+                self.spill_count = int(os.path.basename(self.spilled[-1])[:-6]) + 1
 
-        logging.debug("Spawn starts control thread %s.", control_thread.name)
-        control_thread.start()
+        self.stopped = threading.Event()
+        _start_reporter(self, stats_interval, "Intake statistics")
+
+        self.thread = threading.Thread(target=self._run, name='intake')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def put(self, obj):
+        """
+        Hand over an event. Only blocks with the ``block`` policy.
+        """
+        with self.condition:
+            if self.closed:
+                logging.warn("Intake is closed, dropping event.")
+                self.dropped += 1
+                return
+            self.received += 1
+
+            if len(self.queue) >= self.size or self.spilled:
+                if self.policy == "block":
+                    while len(self.queue) >= self.size and not self.closed:
+                        self.condition.wait()
+                elif self.policy == "drop-oldest":
+                    self.queue.popleft()
+                    self.dropped += 1
+                    logging.warn("Intake is full, dropped oldest event.")
+                elif self.policy == "spill":
+                    self._spill(obj)
+                    self.condition.notify_all()
+                    return
+
+            self.queue.append(obj)
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.condition.notify_all()
+
+    def _spill(self, obj):
+        path = os.path.join(self.spill_dir, '%012i.spill' % self.spill_count)
+        self.spill_count += 1
+        with open(path, 'wb') as f:
+            pickle.dump(serialize(obj), f, pickle.HIGHEST_PROTOCOL)
+        self.spilled.append(path)
+        self.spills += 1
+
+    def _unspill(self):
+        # The file is only removed once the event is dispatched
+        path = self.spilled.popleft()
+        with open(path, 'rb') as f:
+            return deserialize(pickle.load(f)), path
+
+    def _next(self):
+        with self.condition:
+            while not self.queue and not self.spilled:
+                if self.closed or self.halted:
+                    return False, None, None
+                self.condition.wait()
+            if self.halted:
+                return False, None, None
+            if self.queue:
+                obj, path = self.queue.popleft(), None
+            else:
+                obj, path = self._unspill()
+            self.condition.notify_all()
+            return True, obj, path
+
+    def _run(self):
+        while True:
+            ok, obj, path = self._next()
+            if not ok:
+                return
+            try:
+                dispatched = self.dispatch(obj) is not False
+            except Exception:
+                logging.log("Intake dispatch failed", traceback.format_exc(), 'error')
+                dispatched = False
+            if dispatched and path is not None:
+                os.remove(path)
+            with self.condition:
+                if dispatched:
+                    self.dispatched += 1
+                elif path is not None:
+                    logging.warn("Leaving spilled event %s for the next start.", path)
+                else:
+                    self.refused += 1
+
+    def close(self, timeout=None):
+        """
+        Stop accepting events and wait (at most ``timeout`` seconds) for the
+        waiting ones to be dispatched. No more events are dispatched after
+        that. Spilled events that are not dispatched stay on disk.
+
+        Returns:
+            int: The number of events in memory that were not dispatched
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        with self.condition:
+            # Stop taking events, one already being dispatched is finished
+            self.halted = True
+        self.stopped.set()
+        logging.log("Intake statistics", self.statistics(), 'pp')
+        with self.condition:
+            if self.spilled:
+                logging.info("Leaving %i spilled events in %s.",
+                             len(self.spilled), self.spill_dir)
+            left = len(self.queue) + self.refused
+            self.queue.clear()
+            return left
+
+    def statistics(self):
+        """
+        Returns:
+            dict: Queue depth and event counters of the intake
+        """
+        with self.condition:
+            return {
+                'depth': len(self.queue),
+                'max depth': self.max_depth,
+                'spilled depth': len(self.spilled),
+                'received': self.received,
+                'dispatched': self.dispatched,
+                'dropped': self.dropped,
+                'refused': self.refused,
+                'spilled': self.spills,
+            }
+
+
+class Coalescer(object):
+    """
+    Collapses bursts of events for the same key. The first event for a key
+    starts a ``window`` of seconds, during which later events for the key
+    replace it, and at the end of the window only the latest event is passed
+    on to ``dispatch``, from a thread of its own:
+
+        with Coalescer(intake.put, source.key, window=2) as coalescer:
+            source.callback = coalescer.put
+
+    At most ``size`` keys are pending at a time. An event for another key
+    then waits in ``put`` until one has been passed on, so that a blocking
+    ``dispatch`` holds up the source rather than letting events pile up.
+    """
+    def __init__(self, dispatch, key, window=1., size=1000, stats_interval=60):
+        logging.info("Create coalescer with a %f seconds window for %i keys.", window, size)
+        self.dispatch = dispatch
+        self.key = key
+        self.window = window
+        self.size = size
+
+        self.pending = {}
+        self.deadlines = []
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.received = 0
+        self.dispatched = 0
+        self.collapsed = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+        self.stopped = threading.Event()
+        _start_reporter(self, stats_interval, "Coalescer statistics")
+
+        self.thread = threading.Thread(target=self._run, name='coalescer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def put(self, obj):
+        """
+        Hand over an event. Blocks while ``size`` other keys are pending.
+        """
+        key = self.key(obj)
+        with self.condition:
+            while key not in self.pending and len(self.pending) >= self.size \
+                    and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                logging.warn("Coalescer is closed, dropping event.")
+                self.dropped += 1
+                return
+            self.received += 1
+            if key in self.pending:
+                self.collapsed += 1
+                logging.debug("Collapsed event for %s.", repr(key))
+            else:
+                heapq.heappush(self.deadlines, (time.time() + self.window, key))
+                self.condition.notify_all()
+            self.pending[key] = obj
+            self.max_depth = max(self.max_depth, len(self.pending))
+
+    def _next(self):
+        with self.condition:
+            while True:
+                if self.deadlines:
+                    deadline, key = self.deadlines[0]
+                    wait = deadline - time.time()
+                    if wait <= 0 or self.closed:
+                        heapq.heappop(self.deadlines)
+                        self.condition.notify_all()
+                        return True, self.pending.pop(key)
+                elif self.closed:
+                    return False, None
+                else:
+                    wait = None
+                self.condition.wait(wait)
+
+    def _run(self):
+        while True:
+            ok, obj = self._next()
+            if not ok:
+                return
+            try:
+                self.dispatch(obj)
+            except Exception:
+                logging.log("Coalescer dispatch failed", traceback.format_exc(), 'error')
+            with self.condition:
+                self.dispatched += 1
+
+    def close(self, timeout=None):
+        """
+        Pass on all pending events right away and stop.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        self.stopped.set()
+        logging.log("Coalescer statistics", self.statistics(), 'pp')
+
+    def statistics(self):
+        """
+        Returns:
+            dict: Number of pending events and event counters
+        """
+        with self.condition:
+            return {
+                'pending': len(self.pending),
+                'max depth': self.max_depth,
+                'received': self.received,
+                'dispatched': self.dispatched,
+                'collapsed': self.collapsed,
+                'dropped': self.dropped,
+            }
+
+
+class Lanes(object):
+    """
+    Key-affinity dispatch on top of a pool. Tasks spawned with the same key
+    are run one at a time and in order, in a single lane, instead of having
+    several workers wait for each other on a lock:
+
+        lanes = Lanes(pool)
+        lanes.spawn(flow.key(obj), flow.start, obj, logger=logger, log_id=log_id)
+
+    A lane is a pool task that runs the tasks waiting for its key until
+    there are none left, so different keys are still run in parallel. Each
+    task gets a fresh deadline (see :func:`remaining_time`) when it starts,
+    and is recorded in the pool statistics on its own (the lane is not).
+    Workers are called directly, so coroutines (for an event loop pool) are
+    not supported.
+    """
+    def __init__(self, pool, stats_interval=60):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.mailboxes = {}
+
+        self.tasks = 0
+        self.lanes = 0
+        self.max_depth = 0
+        self.dropped = 0
+
+        self.stopped = threading.Event()
+        _start_reporter(self, stats_interval, "Lane statistics")
+
+    def spawn(self, key, worker, *args, **kwargs):
+        priority = kwargs.pop('priority', 0)
+        task = Task(worker, args, kwargs, priority)
+        with self.lock:
+            self.tasks += 1
+            mailbox = self.mailboxes.get(key)
+            if mailbox is not None:
+                mailbox.append(task)
+                self.max_depth = max(self.max_depth, len(mailbox))
+                logging.debug("Queued %s in lane %s.", task.name, repr(key))
+                return True
+            self.mailboxes[key] = collections.deque()
+            self.lanes += 1
+
+        if not self.pool.spawn(self._lane, key, task, priority=priority,
+                               logger=kwargs.get('logger'), log_id=kwargs.get('log_id')):
+            # The pool is draining, so this lane will never run
+            with self.lock:
+                dropped = 1 + len(self.mailboxes.pop(key, ()))
+                self.dropped += dropped
+            logging.warn("Dropped %i tasks in lane %s.", dropped, repr(key))
+            return False
+        return True
+
+    def _lane(self, key, task):
+        timeout = getattr(self.pool, 'timeout', None)
+        stats = getattr(self.pool, 'stats', None)
+        current = current_task()
+        if current is not None:
+            current.counted = False
+        while task is not None:
+            task.started = time.time()
+            if timeout is not None:
+                task.deadline = task.started + timeout
+                if current is not None:
+                    current.deadline = task.deadline
+            failed = False
+            try:
+                task.run()
+            except Exception:
+                failed = True
+                logging.log("Task %s failed" % task.name, traceback.format_exc(), 'error')
+            end_time = time.time()
+            if stats is not None:
+                stats.record(task.started - task.queued, end_time - task.started, failed=failed,
+                             timed_out=task.deadline is not None and end_time > task.deadline)
+
+            with self.lock:
+                mailbox = self.mailboxes[key]
+                if mailbox:
+                    task = mailbox.popleft()
+                else:
+                    del self.mailboxes[key]
+                    task = None
+
+    def close(self):
+        """
+        Stop reporting statistics.
+
+        Returns:
+            int: The number of tasks still waiting in a lane, or dropped
+                 because the pool was draining
+        """
+        self.stopped.set()
+        logging.log("Lane statistics", self.statistics(), 'pp')
+        with self.lock:
+            return self.dropped + sum(len(mailbox) for mailbox in self.mailboxes.values())
+
+    def statistics(self):
+        """
+        Returns:
+            dict: Number of active lanes, waiting tasks and counters
+        """
+        with self.lock:
+            return {
+                'active lanes': len(self.mailboxes),
+                'waiting': sum(len(mailbox) for mailbox in self.mailboxes.values()),
+                'max depth': self.max_depth,
+                'tasks': self.tasks,
+                'lanes': self.lanes,
+                'dropped': self.dropped,
+            }
+
+
+class Batcher(object):
+    """
+    Collects events into batches of at most ``size`` events, waiting at most
+    ``time`` seconds after the first event of a batch for more to come, and
+    passes each batch on to ``dispatch`` from a thread of its own.
+
+    The batches are meant to be run with :meth:`start`, which calls a flow's
+    ``start_batch`` method and reports per-event results:
+
+        def work(objs):
+            pool.spawn(batcher.start, flow.start_batch, objs, logger=logger, log_id=log_id)
+
+        with Batcher(work, size=100, time=0.1) as batcher:
+            source.callback = batcher.put
+
+    ``start_batch`` should return a list with one result per event, where an
+    exception instance or ``False`` means the event failed. Returning
+    ``None`` means all events succeeded, and raising means all failed.
+
+    ``put`` blocks while ``max_waiting`` events (defaults to ``size``) are
+    waiting, which happens when ``dispatch`` blocks on a busy pool, so that
+    the source (or the intake in front of the batcher) is held back.
+    """
+    def __init__(self, dispatch, size=100, time=0.1, stats_interval=60, max_waiting=None):
+        logging.info("Create batcher for %i events or %f seconds.", size, time)
+        self.dispatch = dispatch
+        self.size = size
+        self.time = time
+        self.max_waiting = max(size, max_waiting or size)
+
+        self.batch = []
+        self.first = None
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.batches = 0
+        self.events = 0
+        self.failed = 0
+
+        self.stopped = threading.Event()
+        _start_reporter(self, stats_interval, "Batch statistics")
+
+        self.thread = threading.Thread(target=self._run, name='batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def put(self, obj):
+        """
+        Add an event to the current batch, waiting for room if needed.
+        """
+        with self.condition:
+            while len(self.batch) >= self.max_waiting and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                logging.warn("Batcher is closed, dropping event %s.", repr(obj))
+                return
+            if not self.batch:
+                self.first = time.time()
+            self.batch.append(obj)
+            self.condition.notify_all()
+
+    def _next(self):
+        with self.condition:
+            while True:
+                if self.batch:
+                    wait = self.first + self.time - time.time()
+                    if len(self.batch) >= self.size or wait <= 0 or self.closed:
+                        break
+                elif self.closed:
+                    return None
+                else:
+                    wait = None
+                self.condition.wait(wait)
+            batch, self.batch = self.batch[:self.size], self.batch[self.size:]
+            self.first = time.time()
+            self.condition.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next()
+            if batch is None:
+                return
+            try:
+                self.dispatch(batch)
+            except Exception:
+                logging.log("Batch dispatch failed", traceback.format_exc(), 'error')
+
+    def start(self, start_batch, objs):
+        """
+        Run ``start_batch(objs)`` and report the result of each event.
+        """
+        results = None
+        try:
+            results = start_batch(objs)
+        except Exception as e:
+            results = [e] * len(objs)
+            raise
+        finally:
+            failed = 0
+            for obj, result in zip(objs, results or []):
+                if result is False or isinstance(result, Exception):
+                    failed += 1
+                    logging.error("Batch event %s failed: %s", repr(obj), repr(result))
+            with self.condition:
+                self.batches += 1
+                self.events += len(objs)
+                self.failed += failed
+            logging.info("Batch of %i events done, %i failed.", len(objs), failed)
+
+    def close(self, timeout=None):
+        """
+        Dispatch what has been collected and stop.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        self.stopped.set()
+        logging.log("Batch statistics", self.statistics(), 'pp')
+
+    def statistics(self):
+        """
+        Returns:
+            dict: Batch and event counters of the batcher
+        """
+        with self.condition:
+            return {
+                'waiting': len(self.batch),
+                'batches': self.batches,
+                'events': self.events,
+                'failed': self.failed,
+                'mean batch size': float(self.events) / self.batches if self.batches else None,
+            }
 
 
 class LogId(object):
     """
     Thread-safe incrementer.
-    
+
     Use like this:
 
         log_id = LogId()
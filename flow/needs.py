@@ -19,5 +19,5 @@ class NeedsConfig(object):
 
 
 class NeedsCleanUp(object):
-    def clean_up(self, config):
+    def clean_up(self):
         raise NotImplemented("You must implement clean_up(self)")
@@ -35,11 +35,20 @@ class AssetEntryListener(EventBased, NeedsClient, NeedsStomp):
     """
     def __init__(self):
         self.callback = None
+        self.stomp_url = None
 
     def run(self):
-        stomp_url = _get_asset_stomp_url(self.client)
+        self.stomp_url = stomp_url = _get_asset_stomp_url(self.client)
         self.stomp.register_handler(stomp_url, self.process_asset_event)
 
+    def stop(self):
+        self.callback = None
+        if self.stomp_url is not None:
+            self.stomp.unregister_handler(self.stomp_url)
+
+    def key(self, asset):
+        return asset.id
+
     def process_asset_event(self, event):
         asset = Item(event)
         logging.info('Event for asset %s "%s"', asset.id, asset.title)
@@ -42,6 +42,7 @@ class Interval(EventBased):
         self.window_end = datetime.time(*[int(d) for d in window_end.split(':')]) \
                 if window_end is not None else None
         self.callback = None
+        self.stopped = False
 
         logging.info('Interval: %s seconds', self.interval)
         if self.window_start is not None:
@@ -53,7 +54,7 @@ class Interval(EventBased):
         last = None
         off = 0
 
-        while True:
+        while not self.stopped:
             now = datetime.datetime.now()
             sleep_time = 1.
 
@@ -67,13 +68,18 @@ class Interval(EventBased):
                 if diff is None or diff >= self.interval:
                     off = (diff or self.interval) - self.interval
                     logging.debug('On Interval (after %f seconds, off by %f).', diff or 0, off)
-                    self.callback(None)
+                    if callable(self.callback):
+                        self.callback(None)
                     last = now
                 else:
                     sleep_time = max(0.0001, min(1., self.interval - diff - off))
 
             time.sleep(sleep_time)
 
+    def stop(self):
+        self.callback = None
+        self.stopped = True
+
 
 def in_window(start, end, now):
     now = now.time()
@@ -37,11 +37,20 @@ class UnmanagedFilesListener(EventBased, NeedsClient, NeedsStomp):
         self.location = location
         self.skip_empty_files = skip_empty_files == 'yes'
         self.callback = None
+        self.stomp_url = None
 
     def run(self):
-        stomp_url = _get_location_stomp_url_by_handle(self.location, self.client)
+        self.stomp_url = stomp_url = _get_location_stomp_url_by_handle(self.location, self.client)
         self.stomp.register_handler(stomp_url, self.process_file_event)
 
+    def stop(self):
+        self.callback = None
+        if self.stomp_url is not None:
+            self.stomp.unregister_handler(self.stomp_url)
+
+    def key(self, unmanaged_file):
+        return unmanaged_file.title
+
     def process_file_event(self, event):
         unmanaged_files = UnmanagedFileCollection(event)
         for unmanaged_file in FeedIterator(unmanaged_files, self.client):
@@ -36,6 +36,10 @@ class GenericStompListener(EventBased, NeedsStomp):
     def run(self):
         self.stomp.register_handler(self.stomp_url, self.process_event)
 
+    def stop(self):
+        self.callback = None
+        self.stomp.unregister_handler(self.stomp_url)
+
     def process_event(self, event):
         if callable(self.callback):
             self.callback(event)
@@ -1,7 +1,350 @@
+import os
 import json
+import time
+import Queue
+import cPickle as pickle
+import sqlite3
+import collections
+from threading import Lock, Thread, Condition, Event, local
 
+from vizone import logging
+from vizone.client import HTTPClientError, HTTPServerError
 
-class Store(object):
+from .multi import serialize, deserialize, remaining_time
+
+
+#: Version of a key that is not stored, see :meth:`Store.get`
+MISSING = 'missing'
+
+
+class StoreConflict(Exception):
+    """
+    Raised by a conditional ``put`` or ``delete`` when the stored value has
+    changed since it was read.
+    """
+    pass
+
+
+class StoreUnversioned(RuntimeError):
+    """
+    Raised by ``update`` when the store gives no version to compare with,
+    as when the server does not send ETags.
+    """
+    pass
+
+
+class StoreCache(object):
+    """
+    Bounded, thread-safe LRU cache for a :class:`Store`. Values are kept for
+    ``ttl`` seconds, and missing keys (``None``) for ``negative_ttl``
+    seconds. Values are kept as JSON, so cached objects can not be altered
+    by the caller, together with their version if known.
+    """
+    def __init__(self, size=1000, ttl=30, negative_ttl=5):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = Lock()
+        self._entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: (True, value, version) if cached and fresh, else
+                   (False, None, None)
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return False, None, None
+            self._entries[key] = entry
+            if entry[1] is None:
+                self.negative_hits += 1
+                return True, None, entry[2]
+            self.hits += 1
+        return True, json.loads(entry[1]), entry[2]
+
+    def set(self, key, data, version=None):
+        """
+        Cache the JSON ``data`` (or ``None`` for a missing key) for ``key``,
+        at ``version`` if known.
+        """
+        ttl = self.ttl if data is not None else self.negative_ttl
+        if not ttl:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, data, version)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def statistics(self):
+        """
+        Returns:
+            dict: Size and hit/miss counters of the cache
+        """
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'negative hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit rate': float(self.hits + self.negative_hits) / lookups if lookups else None,
+            }
+
+
+_resolves = {}
+_resolves_lock = Lock()
+
+
+def _deadline():
+    # Calls made from within a pool task give up at the task's deadline
+    remaining = remaining_time()
+    return {} if remaining is None else {'timeout': max(remaining, 1.)}
+
+
+def _client_config_resolve(servicedoc):
+    collection = servicedoc.get_collection_by_keyword('client-config')
+    return collection.get_resolve_by_id('client-config')
+
+
+def _load_snapshot(path, max_age):
+    try:
+        with open(path, 'rb') as f:
+            saved, data = pickle.load(f)
+        if time.time() - saved > max_age:
+            return None
+        return deserialize(data)
+    except Exception as e:
+        logging.warn("Could not load servicedoc snapshot %s: %s", path, str(e))
+        return None
+
+
+def _save_snapshot(path, servicedoc):
+    try:
+        temp = path + '.tmp'
+        with open(temp, 'wb') as f:
+            pickle.dump((time.time(), serialize(servicedoc)), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp, path)
+    except Exception as e:
+        logging.warn("Could not save servicedoc snapshot %s: %s", path, str(e))
+
+
+def _revalidate(client, snapshot):
+    try:
+        servicedoc = client.servicedoc
+        resolve = _client_config_resolve(servicedoc)
+    except Exception as e:
+        logging.warn("Could not revalidate the servicedoc snapshot: %s", str(e))
+        return
+    with _resolves_lock:
+        _resolves[id(client)] = (client, resolve)
+    _save_snapshot(snapshot, servicedoc)
+    logging.debug("Revalidated servicedoc snapshot %s.", snapshot)
+
+
+def client_config_resolve(client, snapshot=None, max_age=86400):
+    """
+    Get the Client Config API resolve of a client. It is looked up in the
+    servicedoc once per client and shared by all :class:`Store` instances
+    using that client.
+
+    With a ``snapshot`` path, the servicedoc is also saved to disk and used
+    from there on the next start if not older than ``max_age`` seconds. It
+    is then revalidated against the server in the background, so that the
+    start does not wait for the servicedoc.
+
+    Args:
+        client (vizone.client.Instance): Viz One client
+        snapshot (str): Path to a servicedoc snapshot file, or ``None``
+        max_age (float): Seconds a snapshot may be used for
+
+    Returns:
+        The resolve used to make Client Config API URLs
+    """
+    with _resolves_lock:
+        entry = _resolves.get(id(client))
+        if entry is not None and entry[0] is client:
+            return entry[1]
+
+        servicedoc = _load_snapshot(snapshot, max_age) \
+                if snapshot and os.path.exists(snapshot) else None
+        if servicedoc is not None:
+            logging.info("Using servicedoc snapshot %s.", snapshot)
+            resolve = _client_config_resolve(servicedoc)
+            revalidate = Thread(target=_revalidate, args=(client, snapshot),
+                                name='servicedoc_revalidate')
+            revalidate.daemon = True
+            revalidate.start()
+        else:
+            servicedoc = client.servicedoc
+            resolve = _client_config_resolve(servicedoc)
+            if snapshot:
+                _save_snapshot(snapshot, servicedoc)
+
+        # The client is kept so that its id is not reused
+        _resolves[id(client)] = (client, resolve)
+        return resolve
+
+
+class _Threads(object):
+    """
+    Long-lived daemon threads running jobs for :func:`_run_many`. Threads
+    are started when there is work and no idle thread, up to ``size``, and
+    stop after ``idle`` seconds without work.
+    """
+    def __init__(self, size=32, idle=60):
+        self.size = size
+        self.idle = idle
+        self._lock = Lock()
+        self._jobs = Queue.Queue()
+        self._count = 0
+        self._idle = 0
+
+    def submit(self, job):
+        with self._lock:
+            self._jobs.put(job)
+            if self._idle == 0 and self._count < self.size:
+                self._count += 1
+                thread = Thread(target=self._work, name='store_%i' % self._count)
+                thread.daemon = True
+                thread.start()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            try:
+                job = self._jobs.get(timeout=self.idle)
+            except Queue.Empty:
+                with self._lock:
+                    self._idle -= 1
+                    # A job may have come in while timing out
+                    if self._jobs.empty():
+                        self._count -= 1
+                        return
+                continue
+            with self._lock:
+                self._idle -= 1
+            job()
+
+
+_threads = _Threads()
+
+
+def _run_many(func, items, parallelism):
+    """
+    Call ``func(key, *args)`` for each ``(key, args)`` in ``items`` using at
+    most ``parallelism`` threads, and get a dict of key to result, or to the
+    exception raised.
+    """
+    results = {}
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+
+    def work():
+        while True:
+            try:
+                key, args = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[key] = func(key, *args)
+            except Exception as e:
+                results[key] = e
+
+    runners = min(parallelism, queue.qsize())
+    if runners <= 1:
+        work()
+        return results
+
+    done = Queue.Queue()
+
+    def run():
+        try:
+            work()
+        finally:
+            done.put(None)
+
+    for _ in range(runners):
+        _threads.submit(run)
+    for _ in range(runners):
+        done.get()
+    return results
+
+
+class _Updatable(object):
+    """
+    Compare-and-swap loop shared by the stores, on top of their versioned
+    ``get`` and conditional ``put`` and ``delete``.
+    """
+    def update(self, key, func, retries=10):
+        """
+        Update the value under ``key`` to ``func(value)`` atomically. If the
+        value is changed by someone else in between, it is read again and
+        ``func`` is called again, so ``func`` must not have side effects.
+        Returning ``None`` deletes the key, and returning the value unchanged
+        skips the write.
+
+        .. code-block:: python
+
+            def add(value):
+                value = value or {'count': 0}
+                value['count'] += 1
+                return value
+
+            self.store.update('counter', add)
+
+        Args:
+            key (unicode): The key to update
+            func (callable): Called with the stored value (or ``None``), to
+                             get the new value
+            retries (int): Number of times to retry on conflict
+
+        Returns:
+            dict: The new value
+
+        Raises:
+            StoreConflict: If still conflicting after ``retries`` retries
+            StoreUnversioned: If the store gives no version to compare with
+        """
+        fresh = False
+        for attempt in range(retries + 1):
+            value, version = self.get(key, versioned=True, fresh=fresh)
+            if version is None:
+                # Writing without a condition would not be atomic
+                raise StoreUnversioned("No version of %s to update with, the server does not "
+                                       "support conditional requests" % repr(key))
+            new_value = func(json.loads(json.dumps(value)))
+            if new_value == value:
+                return new_value
+            try:
+                if new_value is None:
+                    self.delete(key, if_match=version)
+                else:
+                    self.put(key, new_value, if_match=version)
+                return new_value
+            except StoreConflict:
+                logging.debug("Conflict updating %s (attempt %i), retry.", repr(key), attempt + 1)
+                fresh = True
+        raise StoreConflict("Could not update %s in %i attempts" % (repr(key), retries + 1))
+
+
+class Store(_Updatable):
     """
     A Store is a centralized store based on the Client Config API. Note that:
 
@@ -40,77 +383,763 @@ class Store(object):
 
                 # You can also delete
                 self.store.delete('key')
+
+    Values can be cached in-process (see :class:`StoreCache`). The cache is
+    off by default, and is enabled in the ``[Store]`` section of the ini
+    file:
+
+    .. code-block:: ini
+
+        [Store]
+        # keys, 0 (the default) disables
+        cache size = 1000
+        # seconds, 0 disables
+        cache ttl = 30
+        negative cache ttl = 5
+
+    The cache is updated on this instance's own ``put`` and ``delete``, but
+    not on changes made by others, so keep the time to live short if other
+    processes write the same keys.
+
+    The Client Config API is looked up in the servicedoc of the server on
+    first use. To save that request on start, a snapshot of the servicedoc
+    can be kept on disk (see :func:`client_config_resolve`):
+
+    .. code-block:: ini
+
+        [Store]
+        servicedoc snapshot = /var/lib/myflow/servicedoc.snapshot
+
+    To work on many keys at once, use ``get_many``, ``put_many`` and
+    ``delete_many``, which run the requests in parallel over the client's
+    connection pool:
+
+    .. code-block:: python
+
+        results = self.store.get_many(['key1', 'key2'])
+        for key, value in results.items():
+            if isinstance(value, Exception):
+                # this one failed
+
+    When several workers may change the same key at once, make the change
+    with ``update``, which retries on conflicting writes instead of losing
+    one of them. It is built on versioned reads and conditional writes
+    (using the ETag of the server), which can also be used directly:
+
+    .. code-block:: python
+
+        value, version = self.store.get('key', versioned=True)
+        try:
+            self.store.put('key', {'new': 'value'}, if_match=version)
+        except StoreConflict:
+            # someone else changed it in between
     """
-    def __init__(self, appname, client):
+    def __init__(self, appname, client, cache_size=0, cache_ttl=30, negative_cache_ttl=5,
+                 snapshot=None):
         """
-        Store contructor is not lightweight, so you might want to reuse the instance.
+        Store constructor is lightweight, the Client Config API is looked up on
+        first use and only once per client (see :func:`client_config_resolve`).
         It only works with dicts for values and they are stored as JSON strings on
         the server side.
 
         Args:
             appname (unicode): Name of the application, used in the API calls
             client (vizone.client.Instance): Viz One client to use for calls
+            cache_size (int): Number of keys to cache (0 disables the cache)
+            cache_ttl (float): Seconds to cache values
+            negative_cache_ttl (float): Seconds to cache missing keys
+            snapshot (str): Path to a servicedoc snapshot file, or ``None``
         """
         self._appname = appname or ''  # application is optional
         self._client = client
+        self._snapshot = snapshot
+        self._cache = StoreCache(cache_size, cache_ttl, negative_cache_ttl) \
+                if cache_size > 0 else None
 
-        collection = client.servicedoc.get_collection_by_keyword('client-config')
-        self._resolve = collection.get_resolve_by_id('client-config')
-    
-    def get(self, key):
+    @property
+    def _resolve(self):
+        return client_config_resolve(self._client, self._snapshot)
+
+    def _check(self, key, response, conditional=False):
+        if conditional and response.status_code in (404, 409, 412):
+            raise StoreConflict("Stored value of %s has changed" % repr(key))
+        elif response.status_code >= 500:
+            logging.log("HTTP Server Error %i" % response.status_code, response.content, 'xml', debug=False)
+            raise HTTPServerError(response)
+        elif response.status_code >= 400:
+            logging.log("HTTP Client Error %i" % response.status_code, response.content, 'xml', debug=False)
+            raise HTTPClientError(response)
+
+    def _conditions(self, if_match):
+        if if_match is None:
+            return {}
+        elif if_match == MISSING:
+            return {'If-None-Match': '*'}
+        return {'If-Match': if_match}
+
+    def get(self, key, versioned=False, fresh=False):
         """
         Get the value of a certain key for the object's application.
 
         Args:
             key (unicode): The key used for storage
+            versioned (bool): Also return the version, for a conditional
+                              ``put`` or ``delete``
+            fresh (bool): Do not use the cache
 
         Returns:
-            dict: The storede value or ``None``
+            dict: The storede value or ``None``, or a tuple (value, version)
+                  if ``versioned``. The version of a missing key is
+                  :data:`MISSING`.
         """
+        if self._cache is not None and not fresh:
+            cached, value, version = self._cache.get(key)
+            if cached and (version is not None or not versioned):
+                return (value, version) if versioned else value
+        return self._fetch(key, versioned)
+
+    def _fetch(self, key, versioned=False):
+        # Get from the server, bypassing (but updating) the cache
         subs = {'vizid:application': self._appname}
         resolve = self._resolve
 
-        response = self._client.GET(resolve.make_url(key, subs), check_status=False)
+        response = self._client.GET(resolve.make_url(key, subs), check_status=False, **_deadline())
         if response.status_code == 404:
-            return None
-        elif response.status_code >= 500:
-            logging.log("HTTP Server Error %i" % response.status_code, response.content, 'xml', debug=False)
-            raise HTTPServerError(response)
-        elif response.status_code >= 400:
-            logging.log("HTTP Client Error %i" % response.status_code, response.content, 'xml', debug=False)
-            raise HTTPClientError(response)
+            if self._cache is not None:
+                self._cache.set(key, None, MISSING)
+            return (None, MISSING) if versioned else None
+        self._check(key, response)
 
-        if response.content != '':
-            return json.loads(response.content)
-        else:
-            return None
+        version = response.headers.get('ETag')
+        if self._cache is not None:
+            self._cache.set(key, response.content or None, version)
+
+        value = json.loads(response.content) if response.content != '' else None
+        return (value, version) if versioned else value
 
-    def put(self, key, value):
+    def put(self, key, value, if_match=None):
         """
         Put a ``value`` under a ``key`` for the object's application.
 
         Args:
             key (unicode): The key used for storage
             value (dict): The data to store, as a dict
+            if_match (str): Only store if the version is still this one, as
+                            returned by a versioned ``get``
 
         Returns:
             dict: The storede value is returned
+
+        Raises:
+            StoreConflict: If the version did not match
         """
         value = json.dumps(value)
         subs = {'vizid:application': self._appname}
         resolve = self._resolve
+        headers = {'Content-Type': 'application/octet-stream'}
+        headers.update(self._conditions(if_match))
 
-        self._client.PUT(resolve.make_url(key, subs), value, {'Content-Type': 'application/octet-stream'})
+        try:
+            response = self._client.PUT(resolve.make_url(key, subs), value, headers, check_status=False,
+                                        **_deadline())
+            self._check(key, response, conditional=if_match is not None)
+        except Exception:
+            if self._cache is not None:
+                self._cache.invalidate(key)
+            raise
+        if self._cache is not None:
+            self._cache.set(key, value, response.headers.get('ETag'))
         return value
 
-    def delete(self, key):
+    def delete(self, key, if_match=None):
         """
         Delete the stored ``value`` under a ``key`` for the object's application.
 
         Args:
             key (unicode): The key to delete
+            if_match (str): Only delete if the version is still this one, as
+                            returned by a versioned ``get``
+
+        Raises:
+            StoreConflict: If the version did not match
         """
         subs = {'vizid:application': self._appname}
         resolve = self._resolve
 
-        self._client.DELETE(resolve.make_url(key, subs))
+        try:
+            response = self._client.DELETE(resolve.make_url(key, subs),
+                                           headers=self._conditions(if_match), check_status=False,
+                                           **_deadline())
+            # Deleting a missing key is fine, unless it was expected to exist
+            if response.status_code != 404 or if_match is not None:
+                self._check(key, response, conditional=if_match is not None)
+        except Exception:
+            if self._cache is not None:
+                self._cache.invalidate(key)
+            raise
+        if self._cache is not None:
+            self._cache.set(key, None, MISSING)
+
+    def get_many(self, keys, parallelism=8):
+        """
+        Get the values of many keys, running at most ``parallelism`` requests
+        at a time. Cached keys are not requested.
+
+        Args:
+            keys (list): The keys to get
+            parallelism (int): Maximum number of requests in flight
+
+        Returns:
+            dict: key => stored value, ``None`` or the exception raised
+        """
+        results = {}
+        missing = []
+        for key in keys:
+            cached, value, _ = self._cache.get(key) if self._cache is not None else (False, None, None)
+            if cached:
+                results[key] = value
+            else:
+                missing.append((key, ()))
+        results.update(_run_many(self._fetch, missing, parallelism))
+        return results
+
+    def put_many(self, items, parallelism=8):
+        """
+        Put many values, running at most ``parallelism`` requests at a time.
+
+        Args:
+            items (dict): key => value to store
+            parallelism (int): Maximum number of requests in flight
+
+        Returns:
+            dict: key => stored value or the exception raised
+        """
+        return _run_many(self.put, [(key, (value, )) for key, value in items.items()], parallelism)
+
+    def delete_many(self, keys, parallelism=8):
+        """
+        Delete many keys, running at most ``parallelism`` requests at a time.
+
+        Args:
+            keys (list): The keys to delete
+            parallelism (int): Maximum number of requests in flight
+
+        Returns:
+            dict: key => ``None`` or the exception raised
+        """
+        return _run_many(self.delete, [(key, ()) for key in keys], parallelism)
+
+    def statistics(self):
+        """
+        Returns:
+            dict: Cache statistics, see :meth:`StoreCache.statistics`, or
+                  ``None`` if caching is disabled
+        """
+        return self._cache.statistics() if self._cache is not None else None
+
+
+# SQLite before 3.32 allows at most 999 variables per statement, one is
+# taken by the application
+_SqliteMaxKeys = 998
+
+
+class SqliteStore(_Updatable):
+    """
+    A Store kept in a local SQLite database file, for single-node setups where
+    the state does not need to be shared through Viz One. It has the same
+    ``get``, ``put`` and ``delete`` contract as :class:`Store` (and the bulk
+    and versioned variants, and ``update``), and can be used by several
+    threads and processes at once.
+
+    Select it in the ini file:
+
+    .. code-block:: ini
+
+        [Store]
+        engine = sqlite
+        path = /var/lib/myflow/store.sqlite
+    """
+    def __init__(self, appname, path):
+        """
+        Args:
+            appname (unicode): Name of the application, keys are per application
+            path (str): Path to the database file, created if missing
+        """
+        self._appname = appname or ''
+        self._path = path
+        self._local = local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS store ('
+                'application TEXT NOT NULL, '
+                'key TEXT NOT NULL, '
+                'value TEXT NOT NULL, '
+                'version INTEGER NOT NULL DEFAULT 1, '
+                'PRIMARY KEY (application, key))'
+            )
+
+    def _connection(self):
+        # One connection per thread, in WAL mode so readers do not block writers
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key, versioned=False, fresh=False):
+        """
+        Get the value of a certain key for the object's application.
+        See :meth:`Store.get`.
+        """
+        row = self._connection().execute(
+            'SELECT value, version FROM store WHERE application = ? AND key = ?',
+            (self._appname, key),
+        ).fetchone()
+        if row is None:
+            return (None, MISSING) if versioned else None
+        value = json.loads(row[0])
+        return (value, str(row[1])) if versioned else value
+
+    def put(self, key, value, if_match=None):
+        """
+        Put a ``value`` under a ``key`` for the object's application.
+        See :meth:`Store.put`.
+        """
+        if if_match is None:
+            return self.put_many({key: value})[key]
+
+        data = json.dumps(value)
+        with self._connection() as connection:
+            if if_match == MISSING:
+                try:
+                    connection.execute(
+                        'INSERT INTO store (application, key, value) VALUES (?, ?, ?)',
+                        (self._appname, key, data),
+                    )
+                except sqlite3.IntegrityError:
+                    raise StoreConflict("Stored value of %s has changed" % repr(key))
+            elif connection.execute(
+                    'UPDATE store SET value = ?, version = version + 1 '
+                    'WHERE application = ? AND key = ? AND version = ?',
+                    (data, self._appname, key, int(if_match))).rowcount == 0:
+                raise StoreConflict("Stored value of %s has changed" % repr(key))
+        return data
+
+    def delete(self, key, if_match=None):
+        """
+        Delete the stored ``value`` under a ``key`` for the object's application.
+        See :meth:`Store.delete`.
+        """
+        if if_match is None:
+            self.delete_many([key])
+        elif if_match == MISSING:
+            if self.get(key) is not None:
+                raise StoreConflict("Stored value of %s has changed" % repr(key))
+        else:
+            with self._connection() as connection:
+                if connection.execute(
+                        'DELETE FROM store WHERE application = ? AND key = ? AND version = ?',
+                        (self._appname, key, int(if_match))).rowcount == 0:
+                    raise StoreConflict("Stored value of %s has changed" % repr(key))
+
+    def get_many(self, keys, parallelism=None):
+        """
+        Get the values of many keys. See :meth:`Store.get_many`.
+        """
+        connection = self._connection()
+        results = dict((key, None) for key in keys)
+        keys = list(results.keys())
+        for start in range(0, len(keys), _SqliteMaxKeys):
+            chunk = keys[start:start + _SqliteMaxKeys]
+            for key, value in connection.execute(
+                    'SELECT key, value FROM store WHERE application = ? AND key IN (%s)' %
+                    ', '.join('?' * len(chunk)),
+                    [self._appname] + chunk):
+                results[key] = json.loads(value)
+        return results
+
+    def put_many(self, items, parallelism=None):
+        """
+        Put many values in one transaction. See :meth:`Store.put_many`.
+        """
+        values = dict((key, json.dumps(value)) for key, value in items.items())
+        with self._connection() as connection:
+            for key, value in values.items():
+                if connection.execute(
+                        'INSERT OR IGNORE INTO store (application, key, value) VALUES (?, ?, ?)',
+                        (self._appname, key, value)).rowcount == 0:
+                    connection.execute(
+                        'UPDATE store SET value = ?, version = version + 1 '
+                        'WHERE application = ? AND key = ?',
+                        (value, self._appname, key),
+                    )
+        return values
+
+    def delete_many(self, keys, parallelism=None):
+        """
+        Delete many keys in one transaction. See :meth:`Store.delete_many`.
+        """
+        with self._connection() as connection:
+            connection.executemany(
+                'DELETE FROM store WHERE application = ? AND key = ?',
+                [(self._appname, key) for key in keys],
+            )
+        return dict((key, None) for key in keys)
+
+    def statistics(self):
+        """
+        Returns:
+            None: There is no cache
+        """
+        return None
+
+
+class WriteBehindStore(_Updatable):
+    """
+    Write-behind buffer in front of another store. ``put`` and ``delete``
+    return right away, and the changes are written in batches (using
+    ``put_many`` and ``delete_many``) by a thread of its own, at most
+    ``delay`` seconds later. Changes to the same key in between are
+    coalesced, so a key that is put and then deleted again may never be
+    written at all. Reads see the buffered changes.
+
+    Changes of one key are written in order: a newer change is not written
+    while an older one is still in flight. There is no order between keys.
+    Failed writes are retried on the next flush.
+
+    With a ``journal`` file, buffered changes are appended to it before
+    ``put`` and ``delete`` return, and replayed on start, so they survive a
+    crash. The journal is truncated whenever the buffer has been flushed.
+
+    Conditional writes, versioned reads and ``update`` first flush the key
+    and then go to the store directly. Call ``close`` on shutdown to flush
+    everything.
+
+    Only one write-behind store may use a journal file, and it can not be
+    used with the process executor.
+
+    .. code-block:: ini
+
+        [Store]
+        # seconds, 0 disables
+        write behind = 1
+        write behind batch = 100
+        journal = /var/lib/myflow/store.journal
+    """
+    def __init__(self, store, delay=1., batch_size=100, journal=None, parallelism=8):
+        """
+        Args:
+            store (Store|SqliteStore): The store to write to
+            delay (float): Seconds to buffer changes at most
+            batch_size (int): Maximum number of keys written per batch, also
+                              flushing early when that many are buffered
+            journal (str): Path to a journal file, or ``None`` for none
+            parallelism (int): Maximum number of requests in flight per batch
+        """
+        logging.info("Create write-behind store (delay %f seconds, batch size %i).",
+                     delay, batch_size)
+        self.store = store
+        self.delay = delay
+        self.batch_size = batch_size
+        self.parallelism = parallelism
+
+        self._condition = Condition()
+        self._pending = collections.OrderedDict()  # key => JSON data, None to delete
+        self._inflight = {}
+        self._wake = Event()
+        self._closed = False
+
+        self.writes = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.failures = 0
+
+        self._journal_path = journal
+        self._journal = None
+        if journal is not None:
+            self._replay()
+
+        self._thread = Thread(target=self._run, name='store_write_behind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _replay(self):
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path) as f:
+                for line in f:
+                    try:
+                        key, data = json.loads(line)
+                    except ValueError:
+                        # Torn write at the end of the journal
+                        break
+                    self._pending.pop(key, None)
+                    self._pending[key] = data
+            if self._pending:
+                logging.info("Replayed %i changes from store journal %s.",
+                             len(self._pending), self._journal_path)
+        self._rewrite_journal()
+
+    def _rewrite_journal(self):
+        # Called with the condition held, or before the thread is started.
+        # The new journal is written next to the old one and then moved in
+        # place, so a crash in between leaves one of them whole
+        entries = list(self._inflight.items()) + [
+            item for item in self._pending.items() if item[0] not in self._inflight]
+        temp = self._journal_path + '.tmp'
+        with open(temp, 'w') as f:
+            for key, data in entries:
+                f.write(json.dumps([key, data]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if self._journal is not None:
+            self._journal.close()
+        os.rename(temp, self._journal_path)
+        self._journal = open(self._journal_path, 'a')
+        self._journal_lines = len(entries)
+
+    def _buffer(self, key, data):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Write-behind store is closed")
+            if self._journal is not None:
+                self._journal.write(json.dumps([key, data]) + '\n')
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+                self._journal_lines += 1
+            self.writes += 1
+            if self._pending.pop(key, 0) != 0:
+                self.coalesced += 1
+            self._pending[key] = data
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def _buffered(self, key):
+        """
+        Returns:
+            tuple: (True, JSON data or None) if ``key`` has a buffered change,
+                   else (False, None)
+        """
+        with self._condition:
+            if key in self._pending:
+                return True, self._pending[key]
+            if key in self._inflight:
+                return True, self._inflight[key]
+            return False, None
+
+    def _take(self):
+        with self._condition:
+            batch = {}
+            for key in self._pending:
+                if len(batch) == self.batch_size:
+                    break
+                if key not in self._inflight:
+                    batch[key] = self._pending[key]
+            for key, data in batch.items():
+                del self._pending[key]
+                self._inflight[key] = data
+            return batch
+
+    def _write(self, batch):
+        puts = dict((key, json.loads(data)) for key, data in batch.items() if data is not None)
+        deletes = [key for key, data in batch.items() if data is None]
+        results = {}
+        try:
+            if puts:
+                results.update(self.store.put_many(puts, self.parallelism))
+            if deletes:
+                results.update(self.store.delete_many(deletes, self.parallelism))
+        except Exception as e:
+            for key in batch:
+                results.setdefault(key, e)
+
+        with self._condition:
+            for key, data in batch.items():
+                del self._inflight[key]
+                if isinstance(results.get(key), Exception):
+                    self.failures += 1
+                    logging.error("Could not write %s to the store, will retry: %s",
+                                  repr(key), str(results[key]))
+                    if key not in self._pending:
+                        self._pending[key] = data
+                else:
+                    self.flushed += 1
+            if self._journal is not None and not self._inflight and \
+                    (not self._pending or self._journal_lines > 10 * self.batch_size):
+                self._rewrite_journal()
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.delay)
+            self._wake.clear()
+            failed = self.failures
+            while True:
+                batch = self._take()
+                if batch:
+                    self._write(batch)
+                if len(batch) < self.batch_size or self.failures > failed:
+                    break
+            with self._condition:
+                if self._closed and (not self._pending or self.failures > failed):
+                    return
+
+    def flush(self, keys=None, timeout=None):
+        """
+        Write the buffered changes now, and wait for them to be written.
+
+        Args:
+            keys (list): Only wait for these keys
+            timeout (float): Wait at most this many seconds (``None`` is forever)
+
+        Returns:
+            bool: True if everything was written
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        def buffered():
+            if keys is None:
+                return bool(self._pending or self._inflight)
+            return any(key in self._pending or key in self._inflight for key in keys)
+
+        self._wake.set()
+        with self._condition:
+            while buffered():
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                self._condition.wait(0.1)
+                self._wake.set()
+        return True
+
+    def close(self, timeout=30):
+        """
+        Flush and stop. Changes that could not be written within ``timeout``
+        seconds are lost, unless there is a journal.
+
+        Returns:
+            int: Number of changes left unwritten
+        """
+        logging.info("Flushing write-behind store...")
+        with self._condition:
+            self._closed = True
+        self._wake.set()
+        self._thread.join(timeout)
+        with self._condition:
+            left = len(set(self._pending) | set(self._inflight))
+        if left:
+            logging.error("Could not write %i changes to the store.", left)
+        logging.log("Write-behind store statistics", self.statistics(), 'pp')
+        return left
+
+    def get(self, key, versioned=False, fresh=False):
+        """
+        See :meth:`Store.get`.
+        """
+        if versioned:
+            self.flush([key])
+            return self.store.get(key, versioned=True, fresh=fresh)
+        buffered, data = self._buffered(key)
+        if buffered:
+            return json.loads(data) if data is not None else None
+        return self.store.get(key, fresh=fresh)
+
+    def put(self, key, value, if_match=None):
+        """
+        See :meth:`Store.put`.
+        """
+        if if_match is not None:
+            self.flush([key])
+            return self.store.put(key, value, if_match)
+        data = json.dumps(value)
+        self._buffer(key, data)
+        return data
+
+    def delete(self, key, if_match=None):
+        """
+        See :meth:`Store.delete`.
+        """
+        if if_match is not None:
+            self.flush([key])
+            return self.store.delete(key, if_match)
+        self._buffer(key, None)
+
+    def get_many(self, keys, parallelism=8):
+        """
+        See :meth:`Store.get_many`.
+        """
+        results = {}
+        missing = []
+        for key in keys:
+            buffered, data = self._buffered(key)
+            if buffered:
+                results[key] = json.loads(data) if data is not None else None
+            else:
+                missing.append(key)
+        if missing:
+            results.update(self.store.get_many(missing, parallelism))
+        return results
+
+    def put_many(self, items, parallelism=None):
+        """
+        See :meth:`Store.put_many`.
+        """
+        return dict((key, self.put(key, value)) for key, value in items.items())
+
+    def delete_many(self, keys, parallelism=None):
+        """
+        See :meth:`Store.delete_many`.
+        """
+        for key in keys:
+            self.delete(key)
+        return dict((key, None) for key in keys)
+
+    def statistics(self):
+        """
+        Returns:
+            dict: Buffer counters, and the statistics of the store
+        """
+        with self._condition:
+            return {
+                'pending': len(self._pending),
+                'in flight': len(self._inflight),
+                'writes': self.writes,
+                'coalesced': self.coalesced,
+                'flushed': self.flushed,
+                'failures': self.failures,
+                'store': self.store.statistics(),
+            }
+
+
+def create_store(engine, appname, client=None, path=None, write_behind=0,
+                 write_behind_batch=100, journal=None, **kwargs):
+    """
+    Create a store of the given ``engine``.
+
+    Args:
+        engine (str): ``vizone`` (see :class:`Store`) or ``sqlite`` (see :class:`SqliteStore`)
+        appname (unicode): Name of the application
+        client (vizone.client.Instance): Viz One client, for ``vizone``
+        path (str): Database file, for ``sqlite``
+        write_behind (float): Buffer changes for this many seconds (see
+                              :class:`WriteBehindStore`), 0 disables
+        write_behind_batch (int): Maximum number of keys written per batch
+        journal (str): Journal file for the write-behind buffer
+        kwargs: Further arguments for :class:`Store`
+
+    Returns:
+        Store|SqliteStore|WriteBehindStore
+    """
+    if engine == 'vizone':
+        store = Store(appname, client, **kwargs)
+    elif engine == 'sqlite':
+        store = SqliteStore(appname, path)
+    else:
+        raise ValueError("Unknown store engine '%s', use vizone or sqlite" % engine)
+    if write_behind > 0:
+        store = WriteBehindStore(store, write_behind, write_behind_batch, journal)
+    return store
@@ -26,5 +26,8 @@ setup(
     packages=packages_,
     classifiers=classifiers_,
     scripts=[],
-    install_requires=[]
+    install_requires=[],
+    extras_require={
+        'asyncio': ['trollius', 'futures'],
+    },
 )
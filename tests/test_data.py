@@ -0,0 +1,181 @@
+import time
+import threading
+from datetime import datetime
+
+import pytest
+from vizone.iso8601 import Timestamp
+
+from flow import data
+from flow.data import MultiParser, DictionaryCache, DictionaryIndex, _compile_format
+
+
+def baseline(raw_value, type, format, default_timezone):
+    # The conversion as it was done before formats were compiled
+    d = datetime.strptime(raw_value, format)
+    if type == "date":
+        return Timestamp(d.date().isoformat())
+    elif type == "time":
+        return Timestamp(d.time().isoformat())
+    t = Timestamp(d.isoformat())
+    if not t.has_tz():
+        t = t.assume(default_timezone)
+    return t.utc()
+
+
+@pytest.mark.parametrize("format, raw_value", [
+    ("%Y-%m-%d %H:%M:%S", "2016-03-04 05:06:07"),
+    ("%Y-%m-%d %H:%M:%S", "2016-3-4 5:6:7"),
+    ("%Y-%m-%dT%H:%M:%S.%f", "2016-03-04T05:06:07.123"),
+    ("%Y-%m-%dT%H:%M:%S.%f", "2016-03-04T05:06:07.123456"),
+    ("%d/%m/%y", "04/03/16"),
+    ("%d/%m/%y", "04/03/69"),
+    ("%d/%m/%y", "04/03/68"),
+    ("%Y%m%d", "20160304"),
+    ("%Y%m%d%H%M%S", "20160304050607"),
+    ("%H:%M", "23:59"),
+    ("%d %b %Y", "04 Mar 2016"),
+    ("%Y-%m-%d 100%%", "2016-03-04 100%"),
+])
+def test_compile_format_matches_strptime(format, raw_value):
+    assert _compile_format(format)(raw_value) == datetime.strptime(raw_value, format)
+
+
+@pytest.mark.parametrize("format, raw_value", [
+    ("%Y-%m-%d", "2016-13-04"),
+    ("%Y-%m-%d", "2016-02-30"),
+    ("%Y-%m-%d", "2016-03-04 extra"),
+    ("%H:%M:%S", "24:00:00"),
+    ("%d %b %Y", "04 Foo 2016"),
+])
+def test_compile_format_raises_like_strptime(format, raw_value):
+    with pytest.raises(ValueError):
+        datetime.strptime(raw_value, format)
+    with pytest.raises(ValueError):
+        _compile_format(format)(raw_value)
+
+
+@pytest.mark.parametrize("type, format, raw_value", [
+    ("date", "%Y-%m-%d", "2016-03-04"),
+    ("time", "%H:%M:%S", "05:06:07"),
+    ("datetime", "%Y-%m-%d %H:%M:%S", "2016-03-04 05:06:07"),
+    ("datetime", "%Y-%m-%d %H:%M:%S", "2016-07-04 23:30:00"),
+    ("datetime", "%d %b %Y %H:%M", "31 Dec 2016 23:30"),
+])
+@pytest.mark.parametrize("default_timezone", ["UTC", "Europe/Stockholm"])
+def test_convert_matches_baseline(type, format, raw_value, default_timezone):
+    parser = MultiParser(type=type, format=format, default_timezone=default_timezone)
+    expected = str(baseline(raw_value, type, format, default_timezone))
+    assert str(parser.convert(raw_value, None)) == expected
+    # Second time from the memo
+    assert str(parser.convert(raw_value, None)) == expected
+
+
+def test_convert_memo_is_bounded():
+    parser = MultiParser(type="date", format="%Y%m%d", memo_size=2)
+    for raw_value in ("20160301", "20160302", "20160303"):
+        parser.convert(raw_value, None)
+    assert len(parser._memo) <= 2
+
+
+class Term(object):
+    def __init__(self, key):
+        self.key = key
+
+
+class FakeDictionary(object):
+    def __init__(self, keys):
+        self.entries = [Term(key) for key in keys]
+
+
+class SlowLoader(object):
+    # Stands in for _load_dictionary, holding loads until opened
+    def __init__(self, error=None):
+        self.opened = threading.Event()
+        self.error = error
+        self.calls = []
+
+    def __call__(self, source, client):
+        self.calls.append(source)
+        self.opened.wait(5)
+        if self.error is not None:
+            raise self.error
+        return DictionaryIndex(FakeDictionary([source])), None
+
+
+def run_threads(count, target, *args):
+    results = []
+
+    def work():
+        try:
+            results.append(target(*args))
+        except Exception as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=work) for n in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_dictionary_cache_loads_once(monkeypatch):
+    loader = SlowLoader()
+    monkeypatch.setattr(data, '_load_dictionary', loader)
+    cache = DictionaryCache()
+    threads, results = run_threads(8, cache.get, 'a', None)
+    time.sleep(0.1)
+    loader.opened.set()
+    for thread in threads:
+        thread.join(5)
+    assert loader.calls == ['a']
+    assert len(results) == 8
+    assert all(index is results[0] for index in results)
+    assert cache.get('a', None) is results[0]
+    assert cache.statistics()['hits'] == 1
+    assert cache._loading == {}
+
+
+def test_dictionary_cache_shares_errors(monkeypatch):
+    loader = SlowLoader(ValueError("Bad dictionary link: a"))
+    monkeypatch.setattr(data, '_load_dictionary', loader)
+    cache = DictionaryCache()
+    threads, results = run_threads(4, cache.get, 'a', None)
+    time.sleep(0.1)
+    loader.opened.set()
+    for thread in threads:
+        thread.join(5)
+    assert loader.calls == ['a']
+    assert len(results) == 4
+    assert all(isinstance(result, ValueError) for result in results)
+    # Errors are not cached
+    with pytest.raises(ValueError):
+        cache.get('a', None)
+    assert loader.calls == ['a', 'a']
+
+
+def test_dictionary_cache_sources_do_not_wait_for_each_other(monkeypatch):
+    slow = SlowLoader()
+    monkeypatch.setattr(data, '_load_dictionary',
+                        lambda source, client: slow(source, client) if source == 'slow'
+                        else (DictionaryIndex(FakeDictionary([source])), None))
+    cache = DictionaryCache()
+    cache['cached'] = DictionaryIndex(FakeDictionary(['cached']))
+    threads, results = run_threads(1, cache.get, 'slow', None)
+    time.sleep(0.1)
+    assert len(cache.get('other', None)) == 1
+    assert len(cache.get('cached', None)) == 1
+    assert results == []
+    slow.opened.set()
+    threads[0].join(5)
+    assert len(results) == 1
+
+
+def test_dictionary_cache_evicts_least_recently_used():
+    cache = DictionaryCache(size=2)
+    for source in ('a', 'b'):
+        cache[source] = DictionaryIndex(FakeDictionary([source]))
+        time.sleep(0.01)
+    cache.get('a', None)
+    cache['c'] = DictionaryIndex(FakeDictionary(['c']))
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert cache.statistics()['evictions'] == 1
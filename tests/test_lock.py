@@ -0,0 +1,222 @@
+import time
+import threading
+
+import pytest
+
+from flow import lock
+from flow.lock import LockRegistry, Locked, LockTimeout, FileLockBackend, \
+        LockService, LocalLockService, ServiceLockBackend
+
+
+needs_fcntl = pytest.mark.skipif(not lock._have_fcntl, reason="requires fcntl")
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def registry():
+    backend = LockRegistry()
+    lock.set_backend(backend)
+    yield backend
+    lock.set_backend(LockRegistry())
+
+
+def test_registry_hands_over_in_order(registry):
+    order = []
+
+    def work(n):
+        with Locked('key'):
+            order.append(n)
+
+    registry.acquire('key')
+    threads = []
+    for n in range(5):
+        thread = threading.Thread(target=work, args=(n, ))
+        thread.start()
+        threads.append(thread)
+        # Make sure each thread is waiting before starting the next
+        wait_for(lambda: len(registry._entries['key'].waiters) == n + 1)
+    registry.release('key')
+    for thread in threads:
+        thread.join(5)
+    assert order == [0, 1, 2, 3, 4]
+    assert registry.statistics('key')['contended'] == 5
+
+
+def test_registry_non_blocking(registry):
+    assert registry.acquire('key')
+    result = []
+    thread = threading.Thread(target=lambda: result.append(registry.acquire('key', blocking=False)))
+    thread.start()
+    thread.join(5)
+    assert result == [False]
+    registry.release('key')
+    assert not registry.locked('key')
+
+
+def test_registry_timeout(registry):
+    registry.acquire('key')
+    started = time.time()
+    with pytest.raises(LockTimeout):
+        with Locked('key', timeout=0.1):
+            pass
+    assert time.time() - started >= 0.1
+    assert registry.statistics('key')['timeouts'] == 1
+    assert registry.statistics()['timeouts'] == 1
+    # The timed out waiter is no longer in line
+    assert not registry._entries['key'].waiters
+    registry.release('key')
+
+
+def test_registry_forgets_unused_keys(registry):
+    with Locked('a'):
+        with Locked('b'):
+            assert registry.statistics()['keys held'] == 2
+    assert registry._entries == {}
+
+    registry.acquire('a')
+    registry.acquire('a', timeout=0.01)
+    registry.release('a')
+    assert registry._entries == {}
+
+
+def test_registry_release_unlocked_key(registry):
+    registry.release('unknown')
+    with Locked('key'):
+        pass
+    registry.release('key')
+    assert not registry.locked('key')
+
+
+def test_registry_key_statistics_are_bounded():
+    registry = LockRegistry(max_keys=2)
+    for key in ('a', 'b', 'c'):
+        registry.acquire(key)
+        registry.release(key)
+    assert registry.statistics('a') is None
+    assert registry.statistics('c')['count'] == 1
+    assert registry.statistics()['count'] == 3
+
+
+@needs_fcntl
+def test_file_backend_locks_between_instances(tmpdir):
+    # Two backends on the same directory stand in for two processes
+    first = FileLockBackend(str(tmpdir))
+    second = FileLockBackend(str(tmpdir))
+    assert first.acquire(u'key')
+    assert not second.acquire(u'key', blocking=False)
+    started = time.time()
+    assert not second.acquire(u'key', timeout=0.1)
+    assert time.time() - started >= 0.1
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(second.acquire(u'key', timeout=5)))
+    thread.start()
+    time.sleep(0.1)
+    first.release(u'key')
+    thread.join(5)
+    assert result == [True]
+    assert not first.acquire(u'key', blocking=False)
+    second.release(u'key')
+    assert first.acquire(u'key', blocking=False)
+    first.release(u'key')
+
+
+@needs_fcntl
+def test_file_backend_serializes_threads(tmpdir):
+    backend = FileLockBackend(str(tmpdir))
+    inside = []
+    overlaps = []
+
+    def work():
+        for n in range(20):
+            backend.acquire('key')
+            inside.append(1)
+            overlaps.append(len(inside))
+            inside.pop()
+            backend.release('key')
+
+    threads = [threading.Thread(target=work) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert max(overlaps) == 1
+    assert backend.statistics('key')['count'] == 80
+    # Releasing an unlocked key only warns
+    backend.release('key')
+
+
+def test_service_backend():
+    service = LocalLockService()
+    first = ServiceLockBackend(service, lease=30, poll=0.01)
+    second = ServiceLockBackend(service, lease=30, poll=0.01)
+    assert first.acquire('key')
+    assert not second.acquire('key', blocking=False)
+    assert not second.acquire('key', timeout=0.05)
+    first.release('key')
+    assert second.acquire('key', timeout=1)
+    second.release('key')
+    # Releasing an unlocked key only warns
+    second.release('key')
+
+
+def test_service_lease_expires():
+    service = LocalLockService()
+    assert service.acquire('key', 'first', 0.05)
+    assert not service.acquire('key', 'second', 0.05)
+    time.sleep(0.1)
+    assert service.acquire('key', 'second', 30)
+    assert not service.renew('key', 'first', 30)
+    service.release('key', 'first')
+    assert not service.acquire('key', 'first', 30)
+
+
+@needs_fcntl
+def test_file_backend_removes_released_lock_files(tmpdir):
+    backend = FileLockBackend(str(tmpdir))
+    for n in range(10):
+        backend.acquire(u'key-%i' % n)
+    assert len(tmpdir.listdir()) == 10
+    for n in range(10):
+        backend.release(u'key-%i' % n)
+    assert tmpdir.listdir() == []
+
+
+@needs_fcntl
+def test_file_backend_excludes_while_lock_files_come_and_go(tmpdir):
+    # Each backend stands in for a process
+    backends = [FileLockBackend(str(tmpdir)) for n in range(4)]
+    inside = []
+    overlaps = []
+
+    def work(backend):
+        for n in range(50):
+            backend.acquire('key')
+            inside.append(1)
+            overlaps.append(len(inside))
+            inside.pop()
+            backend.release('key')
+
+    threads = [threading.Thread(target=work, args=(backend, )) for backend in backends]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert len(overlaps) == 200
+    assert max(overlaps) == 1
+    assert tmpdir.listdir() == []
+
+
+def test_lock_service_is_abstract():
+    service = LockService()
+    for call in (lambda: service.acquire('key', 'owner', 30),
+                 lambda: service.renew('key', 'owner', 30),
+                 lambda: service.release('key', 'owner')):
+        with pytest.raises(NotImplementedError):
+            call()
@@ -0,0 +1,372 @@
+import os
+import pickle
+import time
+import threading
+
+from flow.multi import Histogram, Statistics, Pool, Intake, Coalescer, Lanes, serialize
+
+
+def test_histogram_empty():
+    assert Histogram().percentile(50) is None
+
+
+def test_histogram_percentiles_within_bucket_resolution():
+    histogram = Histogram()
+    for n in range(1, 101):
+        histogram.add(n / 100.)
+    for p in (1, 50, 95, 99, 100):
+        value = histogram.percentile(p)
+        assert p / 100. <= value <= p / 100. * 1.13
+
+
+def test_histogram_out_of_range():
+    histogram = Histogram(low=0.01, high=10.)
+    histogram.add(0.)
+    histogram.add(1000.)
+    assert histogram.percentile(1) == 0.01
+    assert histogram.percentile(100) == histogram.bounds[-1]
+    assert histogram.total == 2
+
+
+def test_histogram_memory_is_constant():
+    histogram = Histogram()
+    size = len(histogram.counts)
+    for n in range(10000):
+        histogram.add(n * 0.01)
+    assert len(histogram.counts) == size
+    assert sum(histogram.counts) == 10000
+
+
+def test_statistics_snapshot():
+    statistics = Statistics()
+    assert statistics.snapshot()['wait mean'] is None
+    statistics.record(1., 2.)
+    statistics.record(3., 4., failed=True)
+    statistics.record(5., 6., timed_out=True)
+    snapshot = statistics.snapshot()
+    assert snapshot['count'] == 3
+    assert snapshot['failures'] == 1
+    assert snapshot['timeouts'] == 1
+    assert snapshot['wait mean'] == 3.
+    assert snapshot['run mean'] == 4.
+    assert 3. <= snapshot['wait p50'] < 3.5
+    assert 6. <= snapshot['run p99'] < 7.
+
+
+class Gate(object):
+    # A dispatch that holds the intake thread until opened
+    def __init__(self):
+        self.opened = threading.Event()
+        self.entered = threading.Event()
+        self.seen = []
+
+    def __call__(self, obj):
+        self.entered.set()
+        self.opened.wait(5)
+        self.seen.append(obj)
+
+
+def fill(intake, gate, count):
+    # The first event is taken by the intake thread, the rest wait
+    intake.put(0)
+    assert gate.entered.wait(5)
+    for n in range(1, count):
+        intake.put(n)
+
+
+def test_intake_block():
+    gate = Gate()
+    intake = Intake(gate, size=2, policy="block", stats_interval=0)
+    fill(intake, gate, 3)
+    putter = threading.Thread(target=intake.put, args=(3, ))
+    putter.start()
+    putter.join(0.2)
+    assert putter.is_alive()
+    gate.opened.set()
+    putter.join(5)
+    assert not putter.is_alive()
+    assert intake.close(5) == 0
+    assert gate.seen == [0, 1, 2, 3]
+    assert intake.statistics()['max depth'] == 2
+
+
+def test_intake_drop_oldest():
+    gate = Gate()
+    intake = Intake(gate, size=2, policy="drop-oldest", stats_interval=0)
+    fill(intake, gate, 5)
+    gate.opened.set()
+    assert intake.close(5) == 0
+    assert gate.seen == [0, 3, 4]
+    statistics = intake.statistics()
+    assert statistics['received'] == 5
+    assert statistics['dropped'] == 2
+    assert statistics['dispatched'] == 3
+
+
+def test_intake_spill(tmpdir):
+    spill_dir = str(tmpdir.join('spill'))
+    gate = Gate()
+    intake = Intake(gate, size=2, policy="spill", spill_dir=spill_dir, stats_interval=0)
+    fill(intake, gate, 6)
+    assert intake.statistics()['spilled'] == 3
+    assert len(os.listdir(spill_dir)) == 3
+    gate.opened.set()
+    assert intake.close(5) == 0
+    assert gate.seen == [0, 1, 2, 3, 4, 5]
+    assert os.listdir(spill_dir) == []
+
+
+def test_intake_spill_is_picked_up_on_start(tmpdir):
+    # Spilled events left behind by an earlier run
+    spill_dir = tmpdir.mkdir('spill')
+    for n in (2, 3):
+        with open(str(spill_dir.join('%012i.spill' % n)), 'wb') as f:
+            pickle.dump(serialize(n), f, pickle.HIGHEST_PROTOCOL)
+
+    seen = []
+    intake = Intake(seen.append, size=1, policy="spill", spill_dir=str(spill_dir),
+                    stats_interval=0)
+    intake.put(4)
+    intake.close(5)
+    assert seen == [2, 3, 4]
+    assert spill_dir.listdir() == []
+
+
+def test_intake_put_after_close():
+    seen = []
+    intake = Intake(seen.append, stats_interval=0)
+    intake.close(5)
+    intake.put(1)
+    assert seen == []
+    assert intake.statistics()['dropped'] == 1
+
+
+def test_intake_close_leaves_spilled_events_on_disk(tmpdir):
+    # As when the pool starts draining and refuses the events
+    spill_dir = str(tmpdir.join('spill'))
+    gate = Gate()
+    refused = []
+
+    def dispatch(obj):
+        gate(obj)
+        refused.append(obj)
+        return False
+
+    intake = Intake(dispatch, size=2, policy="spill", spill_dir=spill_dir, stats_interval=0)
+    fill(intake, gate, 10)
+    assert len(os.listdir(spill_dir)) == 7
+    assert intake.close(0.2) == 2
+    gate.opened.set()
+    time.sleep(0.1)
+    assert refused == [0]
+    assert len(os.listdir(spill_dir)) == 7
+    statistics = intake.statistics()
+    assert statistics['dispatched'] == 0
+    assert statistics['refused'] == 1
+
+
+def test_intake_keeps_refused_spill_file(tmpdir):
+    spill_dir = tmpdir.mkdir('spill')
+    with open(str(spill_dir.join('%012i.spill' % 0)), 'wb') as f:
+        pickle.dump(serialize('event'), f, pickle.HIGHEST_PROTOCOL)
+    seen = []
+
+    def dispatch(obj):
+        seen.append(obj)
+        return False
+
+    intake = Intake(dispatch, size=1, policy="spill", spill_dir=str(spill_dir),
+                    stats_interval=0)
+    intake.close(5)
+    assert seen == ['event']
+    assert len(spill_dir.listdir()) == 1
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_pool_starts_within_bounds():
+    with Pool(workers=1, min_workers=4, max_workers=16, stats_interval=0) as pool:
+        assert pool.worker_count == 4
+        assert (pool.min_workers, pool.max_workers) == (4, 16)
+    with Pool(workers=8, min_workers=1, max_workers=4, stats_interval=0) as pool:
+        assert pool.worker_count == 4
+    with Pool(workers=2, min_workers=4, stats_interval=0) as pool:
+        assert (pool.worker_count, pool.max_workers) == (4, 4)
+
+
+def test_pool_grows_while_saturated_and_shrinks_when_idle():
+    opened = threading.Event()
+    with Pool(workers=1, min_workers=1, max_workers=3, queue_size=10,
+              scale_interval=0.05, stats_interval=0) as pool:
+        for n in range(6):
+            pool.spawn(opened.wait, 5)
+        wait_for(lambda: pool.worker_count == 3)
+        time.sleep(0.2)
+        assert pool.worker_count == 3
+        opened.set()
+        wait_for(lambda: pool.worker_count == 1)
+        wait_for(lambda: len(pool.threads) == 1)
+
+
+def test_pool_backs_off_on_errors():
+    def fail():
+        time.sleep(0.01)
+        raise ValueError("Server is struggling")
+
+    with Pool(workers=4, min_workers=1, max_workers=4, queue_size=1000,
+              scale_interval=0.05, stats_interval=0) as pool:
+        for n in range(200):
+            pool.spawn(fail)
+        # Shrinks even though tasks are waiting
+        wait_for(lambda: pool.worker_count < 4)
+        assert pool.queue.qsize() > 0
+        pool.drain(0)
+
+
+def test_pool_backs_off_on_latency():
+    delay = [0.001]
+
+    def work():
+        time.sleep(delay[0])
+
+    with Pool(workers=2, min_workers=1, max_workers=2, queue_size=1000,
+              scale_interval=0.1, latency_factor=2., stats_interval=0) as pool:
+        for n in range(100):
+            pool.spawn(work)
+        assert pool.worker_count == 2
+        # Let the usual run time settle while everything is busy
+        wait_for(lambda: pool.stats.count > 50)
+        delay[0] = 0.05
+        for n in range(100):
+            pool.spawn(work)
+        wait_for(lambda: pool.worker_count == 1)
+        assert pool.queue.qsize() > 0
+        pool.drain(0)
+
+
+def first(obj):
+    return obj[0]
+
+
+def test_coalescer_collapses_same_key():
+    seen = []
+    coalescer = Coalescer(seen.append, first, window=0.2, stats_interval=0)
+    for obj in (('a', 1), ('b', 1), ('a', 2), ('a', 3)):
+        coalescer.put(obj)
+    wait_for(lambda: len(seen) == 2)
+    assert seen == [('a', 3), ('b', 1)]
+    coalescer.close(5)
+    statistics = coalescer.statistics()
+    assert statistics['received'] == 4
+    assert statistics['collapsed'] == 2
+    assert statistics['dispatched'] == 2
+
+
+def test_coalescer_window_expiry():
+    seen = []
+    coalescer = Coalescer(seen.append, first, window=0.1, stats_interval=0)
+    started = time.time()
+    coalescer.put(('a', 1))
+    wait_for(lambda: seen)
+    assert time.time() - started >= 0.1
+    # A new window starts after the first has expired
+    coalescer.put(('a', 2))
+    wait_for(lambda: len(seen) == 2)
+    assert seen == [('a', 1), ('a', 2)]
+    coalescer.close(5)
+
+
+def test_coalescer_flushes_on_close():
+    seen = []
+    coalescer = Coalescer(seen.append, first, window=60, stats_interval=0)
+    coalescer.put(('a', 1))
+    coalescer.put(('b', 1))
+    coalescer.close(5)
+    assert sorted(seen) == [('a', 1), ('b', 1)]
+    coalescer.put(('c', 1))
+    assert coalescer.statistics()['dropped'] == 1
+
+
+def test_coalescer_is_bounded():
+    gate = Gate()
+    coalescer = Coalescer(gate, first, window=0, size=2, stats_interval=0)
+    coalescer.put(('a', 1))
+    assert gate.entered.wait(5)
+    coalescer.put(('b', 1))
+    coalescer.put(('c', 1))
+    putter = threading.Thread(target=coalescer.put, args=(('d', 1), ))
+    putter.start()
+    putter.join(0.2)
+    assert putter.is_alive()
+    # Events for pending keys are still collapsed
+    coalescer.put(('b', 2))
+    gate.opened.set()
+    putter.join(5)
+    assert not putter.is_alive()
+    coalescer.close(5)
+    assert gate.seen == [('a', 1), ('b', 2), ('c', 1), ('d', 1)]
+    assert coalescer.statistics()['max depth'] == 2
+
+
+def test_lanes_keep_order_within_a_key():
+    seen = []
+
+    def work(key, n):
+        time.sleep(0.001)
+        seen.append((key, n))
+
+    with Pool(workers=4, queue_size=100, stats_interval=0) as pool:
+        lanes = Lanes(pool, stats_interval=0)
+        for n in range(20):
+            for key in ('a', 'b', 'c'):
+                assert lanes.spawn(key, work, key, n)
+        wait_for(lambda: len(seen) == 60)
+        assert lanes.close() == 0
+    for key in ('a', 'b', 'c'):
+        assert [n for k, n in seen if k == key] == list(range(20))
+
+
+def test_lanes_run_keys_in_parallel():
+    inside = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def work(key):
+        with lock:
+            inside.append(key)
+            overlaps.append(list(inside))
+        time.sleep(0.05)
+        with lock:
+            inside.remove(key)
+
+    with Pool(workers=3, queue_size=100, stats_interval=0) as pool:
+        lanes = Lanes(pool, stats_interval=0)
+        for n in range(3):
+            for key in ('a', 'b', 'c'):
+                lanes.spawn(key, work, key)
+        wait_for(lambda: len(overlaps) == 9)
+        lanes.close()
+    assert max(len(keys) for keys in overlaps) > 1
+    # Never two tasks of the same key at once
+    assert all(len(set(keys)) == len(keys) for keys in overlaps)
+
+
+def test_lanes_record_each_task_in_the_pool():
+    def work(n):
+        if n % 2:
+            raise ValueError("Odd")
+
+    with Pool(workers=2, queue_size=100, stats_interval=0) as pool:
+        lanes = Lanes(pool, stats_interval=0)
+        for n in range(10):
+            lanes.spawn('a', work, n)
+        wait_for(lambda: not lanes.statistics()['active lanes'])
+        lanes.close()
+        statistics = pool.statistics()
+    assert statistics['count'] == 10
+    assert statistics['failures'] == 5
@@ -0,0 +1,245 @@
+import os
+import time
+import threading
+
+import pytest
+
+from flow.store import SqliteStore, WriteBehindStore, StoreConflict, StoreUnversioned, \
+        MISSING
+
+
+class RecordingStore(SqliteStore):
+    # Records the batches written, and can be made to fail or wait
+    def __init__(self, appname, path):
+        super(RecordingStore, self).__init__(appname, path)
+        self.batches = []
+        self.fail = False
+        self.opened = threading.Event()
+        self.opened.set()
+
+    def put_many(self, items, parallelism=None):
+        self.opened.wait(5)
+        if self.fail:
+            raise IOError("Store is down")
+        self.batches.append(('put', sorted(items)))
+        return super(RecordingStore, self).put_many(items, parallelism)
+
+    def delete_many(self, keys, parallelism=None):
+        self.opened.wait(5)
+        if self.fail:
+            raise IOError("Store is down")
+        self.batches.append(('delete', sorted(keys)))
+        return super(RecordingStore, self).delete_many(keys, parallelism)
+
+
+@pytest.fixture
+def backend(tmpdir):
+    return RecordingStore('test', str(tmpdir.join('store.sqlite')))
+
+
+def test_write_behind_coalesces(backend):
+    store = WriteBehindStore(backend, delay=60)
+    store.put('a', 1)
+    store.put('a', 2)
+    store.put('b', 1)
+    store.delete('b')
+    store.delete('c')
+    assert store.get('a') == 2
+    assert store.get('b') is None
+    assert backend.get('a') is None
+    assert store.close(5) == 0
+    assert sorted(backend.batches) == [('delete', ['b', 'c']), ('put', ['a'])]
+    assert backend.get('a') == 2
+    statistics = store.statistics()
+    assert statistics['writes'] == 5
+    assert statistics['coalesced'] == 2
+    assert statistics['flushed'] == 3
+
+
+def test_write_behind_flushes_full_batches(backend):
+    store = WriteBehindStore(backend, delay=60, batch_size=2)
+    store.put('a', 1)
+    store.put('b', 2)
+    assert store.flush(timeout=5)
+    assert backend.batches == [('put', ['a', 'b'])]
+    store.close(5)
+
+
+def test_write_behind_keeps_order_of_a_key(backend):
+    backend.opened.clear()
+    store = WriteBehindStore(backend, delay=0.01)
+    store.put('a', 1)
+    while not store.statistics()['in flight']:
+        time.sleep(0.01)
+    # A newer change waits for the one in flight
+    store.put('a', 2)
+    assert store.get('a') == 2
+    backend.opened.set()
+    assert store.close(5) == 0
+    assert backend.batches == [('put', ['a']), ('put', ['a'])]
+    assert backend.get('a') == 2
+
+
+def test_write_behind_retries_failed_writes(backend):
+    backend.fail = True
+    store = WriteBehindStore(backend, delay=0.01)
+    store.put('a', 1)
+    assert not store.flush(timeout=0.2)
+    assert store.statistics()['failures'] > 0
+    assert store.get('a') == 1
+    backend.fail = False
+    assert store.close(5) == 0
+    assert backend.get('a') == 1
+
+
+def test_write_behind_conditional_writes_go_through(backend):
+    store = WriteBehindStore(backend, delay=60)
+    store.put('a', 1)
+    value, version = store.get('a', versioned=True)
+    assert value == 1
+    store.put('a', 2, if_match=version)
+    assert backend.get('a') == 2
+    store.close(5)
+
+
+def test_write_behind_journal_replay(backend, tmpdir):
+    journal = str(tmpdir.join('store.journal'))
+    # Never flushes, as if the process died before writing
+    crashed = WriteBehindStore(backend, delay=60, journal=journal)
+    crashed.put('a', 1)
+    crashed.put('a', 2)
+    crashed.put('b', 1)
+    crashed.delete('b')
+    with open(journal, 'a') as f:
+        f.write('["c", "torn')
+
+    store = WriteBehindStore(backend, delay=60, journal=journal)
+    assert store.statistics()['pending'] == 2
+    assert store.get('a') == 2
+    assert store.close(5) == 0
+    assert backend.get('a') == 2
+    assert backend.get('b') is None
+    assert backend.get('c') is None
+    with open(journal) as f:
+        assert f.read() == ''
+
+
+def test_write_behind_journal_keeps_unwritten_changes(backend, tmpdir):
+    journal = str(tmpdir.join('store.journal'))
+    backend.fail = True
+    store = WriteBehindStore(backend, delay=0.01, journal=journal)
+    store.put('a', 1)
+    assert store.close(0.5) == 1
+
+    backend.fail = False
+    store = WriteBehindStore(backend, delay=60, journal=journal)
+    assert store.close(5) == 0
+    assert backend.get('a') == 1
+
+
+def test_write_behind_put_after_close(backend):
+    store = WriteBehindStore(backend, delay=60)
+    store.close(5)
+    with pytest.raises(RuntimeError):
+        store.put('a', 1)
+
+
+def test_write_behind_journal_survives_a_failed_rewrite(backend, tmpdir, monkeypatch):
+    journal = str(tmpdir.join('store.journal'))
+    crashed = WriteBehindStore(backend, delay=60, journal=journal)
+    crashed.put('a', 1)
+    crashed.put('b', 2)
+
+    def rename(source, destination):
+        raise OSError("Crashed while rewriting")
+
+    monkeypatch.setattr(os, 'rename', rename)
+    with pytest.raises(OSError):
+        with crashed._condition:
+            crashed._rewrite_journal()
+    monkeypatch.undo()
+
+    store = WriteBehindStore(backend, delay=60, journal=journal)
+    assert store.close(5) == 0
+    assert backend.get_many(['a', 'b']) == {'a': 1, 'b': 2}
+    assert not os.path.exists(journal + '.tmp')
+
+
+@pytest.fixture
+def sqlite(tmpdir):
+    return SqliteStore('test', str(tmpdir.join('store.sqlite')))
+
+
+def test_update_inserts_missing_key(sqlite):
+    assert sqlite.get('a', versioned=True) == (None, MISSING)
+    assert sqlite.update('a', lambda value: {'count': 1}) == {'count': 1}
+    assert sqlite.get('a', versioned=True) == ({'count': 1}, '1')
+
+
+def test_update_returning_none_deletes(sqlite):
+    sqlite.put('a', {'count': 1})
+    assert sqlite.update('a', lambda value: None) is None
+    assert sqlite.get('a') is None
+
+
+def test_update_returning_the_value_skips_the_write(sqlite):
+    sqlite.put('a', {'count': 1})
+    assert sqlite.update('a', lambda value: value) == {'count': 1}
+    assert sqlite.get('a', versioned=True) == ({'count': 1}, '1')
+
+
+def test_update_retries_on_conflict(sqlite):
+    sqlite.put('a', {'count': 0})
+    calls = []
+
+    def add(value):
+        calls.append(value['count'])
+        if len(calls) == 1:
+            # Someone else writes in between
+            sqlite.put('a', {'count': 10})
+        value['count'] += 1
+        return value
+
+    assert sqlite.update('a', add) == {'count': 11}
+    assert calls == [0, 10]
+    assert sqlite.get('a') == {'count': 11}
+
+
+def test_update_gives_up_after_retries(sqlite):
+    def interfere(value):
+        sqlite.put('a', {'other': True})
+        return {'mine': True}
+
+    with pytest.raises(StoreConflict):
+        sqlite.update('a', interfere, retries=2)
+
+
+def test_update_from_many_threads(sqlite):
+    def add(value):
+        value = value or {'count': 0}
+        value['count'] += 1
+        return value
+
+    def work():
+        for n in range(20):
+            sqlite.update('counter', add, retries=1000)
+
+    threads = [threading.Thread(target=work) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert sqlite.get('counter') == {'count': 80}
+
+
+def test_update_refuses_unversioned_store(sqlite):
+    class Unversioned(SqliteStore):
+        def get(self, key, versioned=False, fresh=False):
+            value = super(Unversioned, self).get(key)
+            return (value, None) if versioned else value
+
+    store = Unversioned('test', sqlite._path)
+    store.put('a', {'count': 1})
+    with pytest.raises(StoreUnversioned):
+        store.update('a', lambda value: None)
+    assert store.get('a') == {'count': 1}